@@ -0,0 +1,171 @@
+import asyncio
+import os
+import re
+from collections import Counter, OrderedDict
+import discord
+
+VIDEO_ID = re.compile(r'^[\w-]+$')
+
+def process_cpu_seconds(pid):
+    # User plus system CPU time of a running process, from /proc. None where that is not available
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            fields = f.read().rsplit(b')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MeteredSource(discord.AudioSource):
+    # Wraps an FFmpeg source to read its process's CPU time just before it is cleaned up
+    def __init__(self, source, on_cleanup):
+        self.source = source
+        self.on_cleanup = on_cleanup
+
+    def read(self):
+        return self.source.read()
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        process = getattr(self.source, '_process', None)
+        cpu = process_cpu_seconds(process.pid) if process else None
+        self.source.cleanup()
+        self.on_cleanup(cpu)
+
+
+class AudioCache:
+    # Ogg Opus files of tracks played at least `min_plays` times, keyed by video id and kept under
+    # `max_bytes` by evicting the least recently played. Cached files are sent to Discord as they
+    # are, without FFmpeg decoding and re-encoding them
+    def __init__(self, directory, max_bytes, min_plays=2, workers=2, bitrate='128k'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.bitrate = bitrate
+        self.semaphore = asyncio.Semaphore(workers)
+        self.files = OrderedDict()
+        self.size = 0
+        self.plays = Counter()
+        self.downloading = set()
+        self.tasks = set()
+        self.stats = Counter()
+        # CPU seconds and streams, by 'cached' or 'streamed'
+        self.cpu = Counter()
+        self.streams = Counter()
+
+    async def load(self):
+        # Rebuilds the index from the directory, least recently used first
+        self.files, self.size = await asyncio.to_thread(self.scan)
+
+    def scan(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.opus'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name[:-len('.opus')], stat.st_size))
+                elif entry.name.endswith('.part'):
+                    # Left over from a download that was interrupted
+                    os.remove(entry.path)
+        entries.sort()
+        return OrderedDict((video_id, size) for mtime, video_id, size in entries), sum(size for mtime, video_id, size in entries)
+
+    def path(self, video_id):
+        return os.path.join(self.directory, f'{video_id}.opus')
+
+    def get(self, video_id):
+        # Returns the cached file's path, or None
+        if video_id not in self.files:
+            self.stats["misses"] += 1
+            return None
+        self.files.move_to_end(video_id)
+        self.stats["hits"] += 1
+        self.stats["bytes_saved"] += self.files[video_id]
+        path = self.path(video_id)
+        # The mtime carries the LRU order across restarts
+        os.utime(path)
+        return path
+
+    def record_play(self, video_id, stream_url):
+        # Counts a streamed play and starts caching the track once it has been played often enough
+        if not video_id or not VIDEO_ID.match(video_id):
+            return
+        self.plays[video_id] += 1
+        if self.plays[video_id] >= self.min_plays and video_id not in self.files and video_id not in self.downloading:
+            self.downloading.add(video_id)
+            task = asyncio.get_running_loop().create_task(self.download(video_id, stream_url))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def download(self, video_id, stream_url):
+        path = self.path(video_id)
+        part = path + '.part'
+        process = None
+        try:
+            async with self.semaphore:
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-nostdin', '-loglevel', 'error', '-y',
+                    '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5',
+                    '-i', stream_url, '-vn', '-c:a', 'libopus', '-b:a', self.bitrate, '-ar', '48000', '-ac', '2',
+                    '-f', 'ogg', part,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                _, stderr = await process.communicate()
+            if process.returncode != 0:
+                self.stats["download_errors"] += 1
+                print(f"Could not cache {video_id}: {stderr.decode(errors='replace').strip()}")
+                return
+            await asyncio.to_thread(os.replace, part, path)
+            size = os.path.getsize(path)
+            self.files[video_id] = size
+            self.size += size
+            self.plays.pop(video_id, None)
+            self.stats["downloads"] += 1
+            await self.evict()
+        except OSError as e:
+            self.stats["download_errors"] += 1
+            print(f"Could not cache {video_id}: {e}")
+        finally:
+            if process and process.returncode is None:
+                process.kill()
+            self.downloading.discard(video_id)
+            if os.path.exists(part):
+                os.remove(part)
+
+    async def evict(self):
+        while self.size > self.max_bytes and len(self.files) > 1:
+            video_id, size = self.files.popitem(last=False)
+            self.size -= size
+            self.stats["evictions"] += 1
+            try:
+                await asyncio.to_thread(os.remove, self.path(video_id))
+            except FileNotFoundError:
+                pass
+
+    def source(self, path, offset=0):
+        before_options = f'-ss {offset:.1f}' if offset else None
+        return self.metered(discord.FFmpegOpusAudio(path, codec='copy', before_options=before_options), 'cached')
+
+    def metered(self, source, kind):
+        self.streams[kind] += 1
+
+        def on_cleanup(cpu):
+            if cpu is not None:
+                self.cpu[kind] += cpu
+        return MeteredSource(source, on_cleanup)
+
+    async def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+    def stats_report(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        hit_rate = self.stats["hits"] / lookups if lookups else 0
+        cpu = " ".join(f"{kind}={self.cpu[kind] / self.streams[kind]:.2f}s" for kind in ("cached", "streamed") if self.streams[kind])
+        return (f"{len(self.files)} files, {self.size / 2 ** 20:.1f}/{self.max_bytes / 2 ** 20:.0f} MiB, "
+                f"hits={self.stats['hits']} misses={self.stats['misses']} hit rate={hit_rate:.0%} "
+                f"saved={self.stats['bytes_saved'] / 2 ** 20:.1f} MiB downloads={self.stats['downloads']} "
+                f"evictions={self.stats['evictions']} errors={self.stats['download_errors']}\n"
+                f"FFmpeg CPU per stream: {cpu or 'n/a'}")
@@ -0,0 +1,111 @@
+import random
+import time
+from collections import Counter
+from utils import WordFilter, LatencyHistogram
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return self.tokens
+
+
+class RuleSet:
+    # Filter words and responses for one scope. Anything a scope leaves out is inherited from its
+    # parent (channel -> guild -> global), reusing the parent's compiled filter
+    def __init__(self, config, parent=None, latency=None):
+        self.enabled = config.get("enabled", parent.enabled if parent else True)
+        whole_words = config.get("filter_whole_words", parent.word_filter.whole_words if parent else False)
+        if "filter_words" in config or parent is None or whole_words != parent.word_filter.whole_words:
+            words = config.get("filter_words", parent.word_filter.words if parent else [])
+            self.word_filter = WordFilter(words, whole_words, latency)
+        else:
+            self.word_filter = parent.word_filter
+        self.responses = tuple(config.get("responses", parent.responses if parent else ()))
+
+
+class AutoResponder:
+    # Picks a response for messages that hit a filter word, rate limited per channel and per user
+    # with token buckets so busy channels drop replies instead of queueing sends
+    DEFAULT_RATES = {"channel": {"rate": 0.2, "burst": 3}, "user": {"rate": 0.05, "burst": 1}}
+
+    def __init__(self, config):
+        self.latency = LatencyHistogram(WordFilter.LATENCY_BUCKETS)
+        self.stats = Counter()
+        self.channel_buckets = {}
+        self.user_buckets = {}
+        self.update(config)
+
+    def update(self, config):
+        self.default = RuleSet(config, latency=self.latency)
+        # guild id -> (guild rules, {channel id: channel rules})
+        self.guilds = {}
+        for guild_id, guild_config in config.get("guilds", {}).items():
+            guild_rules = RuleSet(guild_config, self.default, self.latency)
+            channels = {int(channel_id): RuleSet(channel_config, guild_rules, self.latency)
+                        for channel_id, channel_config in guild_config.get("channels", {}).items()}
+            self.guilds[int(guild_id)] = (guild_rules, channels)
+
+        rates = {**self.DEFAULT_RATES, **config.get("response_rate", {})}
+        self.channel_rate = (rates["channel"]["rate"], rates["channel"]["burst"])
+        self.user_rate = (rates["user"]["rate"], rates["user"]["burst"])
+
+    def all_responses(self):
+        responses = set(self.default.responses)
+        for guild_rules, channels in self.guilds.values():
+            responses.update(guild_rules.responses)
+            for channel_rules in channels.values():
+                responses.update(channel_rules.responses)
+        return responses
+
+    def rules_for(self, guild_id, channel_id):
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            return self.default
+        guild_rules, channels = guild
+        return channels.get(channel_id, guild_rules)
+
+    def bucket(self, buckets, key, rate, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= 10000:
+                self.prune(buckets, rate, now)
+            bucket = buckets[key] = TokenBucket(rate[1], now)
+        bucket.refill(rate[0], rate[1], now)
+        return bucket
+
+    def prune(self, buckets, rate, now):
+        # A bucket that has refilled completely holds no state worth keeping
+        for key in [key for key, bucket in buckets.items() if bucket.refill(rate[0], rate[1], now) >= rate[1]]:
+            del buckets[key]
+
+    def respond(self, guild_id, channel_id, user_id, content):
+        rules = self.rules_for(guild_id, channel_id)
+        if not rules.enabled or not rules.responses or not rules.word_filter.search(content.lower()):
+            return None
+
+        now = time.monotonic()
+        user_bucket = self.bucket(self.user_buckets, user_id, self.user_rate, now)
+        channel_bucket = self.bucket(self.channel_buckets, channel_id, self.channel_rate, now)
+        if user_bucket.tokens < 1:
+            self.stats["suppressed_user"] += 1
+            return None
+        if channel_bucket.tokens < 1:
+            self.stats["suppressed_channel"] += 1
+            return None
+
+        user_bucket.tokens -= 1
+        channel_bucket.tokens -= 1
+        self.stats["sent"] += 1
+        return random.choice(rules.responses)
+
+    def stats_report(self):
+        return (f"sent={self.stats['sent']} suppressed_channel={self.stats['suppressed_channel']} "
+                f"suppressed_user={self.stats['suppressed_user']} guild_rule_sets={len(self.guilds)}\n"
+                f"match latency: {self.latency.summary()}")
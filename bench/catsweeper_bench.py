@@ -0,0 +1,123 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from games.catsweeper import CatsweeperGame
+
+# Board generation and reveal for the NumPy CatsweeperGame at sizes well past the command's 10x10
+# cap, against the nested-list engine it replaced where that one finishes in reasonable time: old
+# generation up to 300x300, and the old reveal, which recurses once per cell, up to 100x100.
+#   python bench/catsweeper_bench.py [sizes ...]     default: 10 100 300 1000 3000
+
+class OldCatsweeperGame:
+    # The nested-list engine, without the Discord view
+    def __init__(self, size=5, bombs=5):
+        self.size = size
+        self.bombs = bombs
+        self.board = [[0 for _ in range(size)] for _ in range(size)]
+        self.mask = [[False for _ in range(size)] for _ in range(size)]
+        self.place_bombs()
+        self.calculate_numbers()
+
+    def place_bombs(self):
+        placed_bombs = 0
+        while placed_bombs < self.bombs:
+            x = random.randint(0, self.size - 1)
+            y = random.randint(0, self.size - 1)
+            if self.board[y][x] == 0:
+                self.board[y][x] = -1
+                placed_bombs += 1
+
+    def calculate_numbers(self):
+        for y in range(self.size):
+            for x in range(self.size):
+                if self.board[y][x] == -1:
+                    continue
+                count = 0
+                for dy in [-1, 0, 1]:
+                    for dx in [-1, 0, 1]:
+                        if 0 <= x + dx < self.size and 0 <= y + dy < self.size:
+                            if self.board[y + dy][x + dx] == -1:
+                                count += 1
+                self.board[y][x] = count
+
+    def reveal(self, x, y):
+        if self.mask[y][x]:
+            return
+        self.mask[y][x] = True
+        if self.board[y][x] == 0:
+            for dy in [-1, 0, 1]:
+                for dx in [-1, 0, 1]:
+                    if 0 <= x + dx < self.size and 0 <= y + dy < self.size:
+                        self.reveal(x + dx, y + dy)
+
+    def check_win(self):
+        for y in range(self.size):
+            for x in range(self.size):
+                if self.board[y][x] != -1 and not self.mask[y][x]:
+                    return False
+        return True
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+def check(game):
+    # Neighbour counts match a direct count, and the win counter matches a full scan
+    board = game.board.tolist()
+    size = game.size
+    for y in range(size):
+        for x in range(size):
+            if board[y][x] != -1:
+                assert board[y][x] == sum(board[ny][nx] == -1 for ny in range(max(y - 1, 0), min(y + 2, size))
+                                          for nx in range(max(x - 1, 0), min(x + 2, size)))
+    assert game.check_win() == all(board[y][x] == -1 or game.mask[y][x] for y in range(size) for x in range(size))
+
+def row(label, size, old, new):
+    old_text = f"{old * 1e3:10.2f}ms" if old is not None else f"{'-':>12}"
+    speedup = f"{old / new:7.1f}x" if old is not None else f"{'':>8}"
+    print(f"{label:<24} {size:>5}x{size:<5} {old_text} {new * 1e3:10.2f}ms {speedup}")
+
+def main():
+    sys.setrecursionlimit(100000)
+    # The first NumPy calls pay for imports and caches, keep that out of the 10x10 numbers
+    CatsweeperGame(10, 10).reveal(0, 0)
+    print(f"{'':<24} {'board':>11} {'old':>12} {'new':>12} {'speedup':>8}")
+    for size in [int(arg) for arg in sys.argv[1:]] or [10, 100, 300, 1000, 3000]:
+        cells = size * size
+        for label, bombs in (("generate, 15% bombs", cells * 15 // 100), ("generate, 90% bombs", cells * 90 // 100)):
+            new, game = timed(lambda: CatsweeperGame(size, bombs))
+            old = timed(lambda: OldCatsweeperGame(size, bombs))[0] if size <= 300 else None
+            if size <= 100:
+                check(game)
+            row(label, size, old, new)
+
+        # One click that flood fills the whole board, then the win check
+        game = CatsweeperGame(size, 1)
+        x, y = (0, 0) if game.board[0][0] == 0 else (size - 1, size - 1)
+        new, _ = timed(lambda: (game.reveal(x, y), game.check_win()))
+        old = None
+        if size <= 100:
+            old_game = OldCatsweeperGame(size, 1)
+            old = timed(lambda: (old_game.reveal(0, 0), old_game.check_win()))[0]
+            check(game)
+        row("reveal whole board", size, old, new)
+
+        # Clicking every safe cell one by one on a dense board, each followed by the win check
+        if size <= 300:
+            game = CatsweeperGame(size, cells * 15 // 100)
+            safe = [(x, y) for y in range(size) for x in range(size) if game.board[y][x] != -1]
+            new, _ = timed(lambda: [(game.reveal(x, y), game.check_win()) for x, y in safe])
+            assert game.check_win()
+            old = None
+            if size <= 100:
+                old_game = OldCatsweeperGame(size, cells * 15 // 100)
+                old_safe = [(x, y) for y in range(size) for x in range(size) if old_game.board[y][x] != -1]
+                old = timed(lambda: [(old_game.reveal(x, y), old_game.check_win()) for x, y in old_safe])[0]
+            row("click every safe cell", size, old, new)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import asyncio
+import os
+import random
+import sys
+import time
+import mongomock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database import Database
+from economy import Economy_Cog
+from user_cache import UserCache, Transaction
+
+# Stress check for the economy transactions against mongomock: 1,000 concurrent gives through the
+# command with a tiny cache, then a batch of linked gives whose debits are rejected by Mongo because
+# balances were drained behind the cache's back, then gives queued while close() meets a flush in
+# progress. Exits non-zero if a balance goes negative, money is created or a write is lost.
+#   python bench/give_stress.py
+
+USERS = 20
+GIVES = 1000
+
+class Bot:
+    def get_user(self, user_id):
+        return None
+
+class Author:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.mention = f"<@{user_id}>"
+
+class Ctx:
+    def __init__(self, user_id):
+        self.author = Author(user_id)
+
+    async def send(self, *args, **kwargs):
+        pass
+
+def balances(client):
+    return {document["user_id"]: document["balance"] for document in client["users"]["users"].find({})}
+
+async def concurrent_gives():
+    client = mongomock.MongoClient()
+    cog = Economy_Cog(Bot(), None, 'shopdata/shopdata.json', 'shopdata/stocks.json', 100, mongo_client=client,
+                      cache_size=5, flush_ops=10, flush_interval_ms=5)
+    await cog.cog_load()
+    for user_id in range(USERS):
+        await cog.daily.callback(cog, Ctx(user_id))
+    await asyncio.gather(*[cog.give.callback(cog, Ctx(random.randrange(USERS)), Author(random.randrange(USERS)), random.randint(1, 300))
+                           for _ in range(GIVES)])
+    await cog.cog_unload()
+
+    stored = balances(client)
+    print(f"{GIVES} concurrent gives: min balance={min(stored.values())} total={sum(stored.values())} "
+          f"committed={cog.user_cache.stats['transactions']} rejected={cog.user_cache.stats['rejected_transactions']}")
+    assert len(stored) == USERS
+    assert min(stored.values()) >= 0
+    assert sum(stored.values()) == USERS * cog.daily_amount
+
+async def rejected_gives():
+    # Every sender gives to the next user, then an outside writer spends half the senders' money
+    # before the flush. Their debits fail the Mongo guard, and the matching credits must fail too
+    client = mongomock.MongoClient()
+    database = Database(client=client, pool_size=2)
+    users = database.collection("users")
+    cache = UserCache(users, {"balance": 0}, flush_interval_ms=60 * 1000, flush_ops=10 ** 6)
+    for user_id in range(USERS):
+        await cache.update(user_id, inc={"balance": 100})
+    await cache.flush()
+
+    for user_id in range(0, USERS, 2):
+        assert await Transaction(cache).debit(user_id, "balance", 80).credit(user_id + 1, "balance", 80).commit() is not None
+    drained = 0
+    for user_id in range(0, USERS, 4):
+        await users.update_one({"user_id": user_id}, {"$inc": {"balance": -50}})
+        drained += 50
+    await cache.flush()
+    stored = balances(client)
+    # The cached copies of the rejected users are rebuilt from what Mongo kept
+    cached = {user_id: (await cache.get(user_id))["balance"] for user_id in range(USERS)}
+    database.close()
+
+    print(f"linked gives with rejected debits: min balance={min(stored.values())} total={sum(stored.values())} "
+          f"guard failures={cache.stats['guard_failures']}")
+    assert min(stored.values()) >= 0
+    assert sum(stored.values()) == USERS * 100 - drained
+    assert cache.stats["guard_failures"] == 2 * len(range(0, USERS, 4))
+    assert cached == stored
+
+async def shutdown_mid_flush():
+    # Plain credits for the first half of the users and gives between the second half, queued so
+    # the background flush is part way through its slow bulk write when close() is called. The
+    # gives are written after the bulk write and must not be lost
+    client = mongomock.MongoClient()
+    database = Database(client=client, pool_size=2)
+    users = database.collection("users")
+    cache = UserCache(users, {"balance": 0}, flush_interval_ms=20)
+    cache.start()
+    for user_id in range(USERS):
+        await cache.update(user_id, inc={"balance": 100})
+    await cache.flush()
+
+    collection = users.collection
+    bulk_write = collection.bulk_write
+    collection.bulk_write = lambda *args, **kwargs: (time.sleep(0.2), bulk_write(*args, **kwargs))[1]
+    half = USERS // 2
+    for user_id in range(half):
+        await cache.update(user_id, inc={"balance": 5})
+    for user_id in range(half, USERS, 2):
+        await Transaction(cache).debit(user_id, "balance", 30).credit(user_id + 1, "balance", 30).commit()
+    await asyncio.sleep(0.1)
+    await cache.close()
+    database.close()
+
+    stored = balances(client)
+    print(f"close() during a flush: total={sum(stored.values())}")
+    assert all(stored[user_id] == 105 for user_id in range(half))
+    assert all(stored[user_id] == 70 and stored[user_id + 1] == 130 for user_id in range(half, USERS, 2))
+
+async def main():
+    await concurrent_gives()
+    await rejected_gives()
+    await shutdown_mid_flush()
+    print("ok")
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    asyncio.run(main())
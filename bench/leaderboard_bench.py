@@ -0,0 +1,77 @@
+import asyncio
+import os
+import random
+import sys
+import time
+import mongomock
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database import Database
+from leaderboard import Leaderboard
+from schema import ensure_indexes
+from stock_engine import QuoteTable
+from user_cache import UserCache
+
+# Cold leaderboard query (sorted find on every call, what the command used to do) against the
+# maintained top-K board, plus what keeping the board current costs per balance change.
+# Uses mongomock unless MONGO_URI is set, in which case a throwaway "leaderboard_bench" database
+# is used. mongomock has no indexes, so its cold numbers are collection scans.
+#   python bench/leaderboard_bench.py [users ...]     default: 100000 1000000
+
+CALLS = 200
+UPDATES = 10000
+
+async def bench(user_count):
+    uri = os.environ.get('MONGO_URI')
+    client = MongoClient(uri) if uri else mongomock.MongoClient()
+    client.drop_database("leaderboard_bench")
+    database = Database(client=client, name="leaderboard_bench")
+    if uri:
+        # mongomock checks unique indexes by scanning, which would make loading quadratic
+        await database.call(ensure_indexes)
+    users = database.collection("users")
+    batch = 50000
+    for start in range(0, user_count, batch):
+        documents = [{"user_id": user_id, "balance": random.randint(0, 10 ** 6), "portfolio": {}}
+                     for user_id in range(start, min(start + batch, user_count))]
+        await database.call(lambda db: db["users"].insert_many(documents))
+
+    # mongomock scans and copies every document per query, a few calls are enough there
+    calls = CALLS if uri else 3
+    start = time.perf_counter()
+    for _ in range(calls):
+        await users.find({}, {"user_id": 1, "balance": 1}, sort=[("balance", -1)], limit=10)
+    cold = (time.perf_counter() - start) / calls
+
+    cache = UserCache(users, {"balance": 0}, max_size=UPDATES)
+    rankings = Leaderboard(users, cache, QuoteTable())
+    start = time.perf_counter()
+    await rankings.page(1)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(CALLS):
+        await rankings.page(random.randint(1, rankings.max_pages))
+    top_k = (time.perf_counter() - start) / CALLS
+
+    # Balance changes as the cache reports them, half of them landing in the top-K
+    top = rankings.boards[(None, "balance")].ranked
+    changes = [(random.randrange(user_count), random.randint(0, 2 * 10 ** 6)) for _ in range(UPDATES)]
+    start = time.perf_counter()
+    for user_id, balance in changes:
+        rankings.on_user_changed(user_id, {"balance": balance})
+    update = (time.perf_counter() - start) / UPDATES
+    assert len(top.keys) == rankings.capacity
+
+    print(f"{user_count:>8} users: cold query {cold * 1e3:8.2f} ms/call | top-K build {build * 1e3:8.1f} ms, "
+          f"page {top_k * 1e6:6.1f} us/call, update {update * 1e6:5.1f} us/change")
+    client.drop_database("leaderboard_bench")
+    database.close()
+
+async def main():
+    for user_count in [int(arg) for arg in sys.argv[1:]] or [100000, 1000000]:
+        await bench(user_count)
+
+if __name__ == "__main__":
+    asyncio.run(main())
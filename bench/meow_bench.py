@@ -0,0 +1,72 @@
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import MeowEncoderDecoder
+
+# Old vs table-driven MeowEncoderDecoder on 1 KB to 1 MB inputs, plus the chunked streaming API.
+# Every output is checked against the old implementation before anything is timed.
+#   python bench/meow_bench.py [sizes in bytes ...]     default: 1024 10240 102400 1048576
+
+class OldMeowEncoderDecoder(MeowEncoderDecoder):
+    # The character-by-character loops the table-driven versions replaced
+    def encode_message(self, message):
+        encoded_message = []
+
+        for char in message.upper():
+            if char in self.encoding_map:
+                encoded_message.append(self.encoding_map[char])
+            else:
+                encoded_message.append(char) # Leave non-alphabetic characters as they are
+
+        return ' '.join(encoded_message)
+
+    def decode_message(self, meow_message):
+        meow_parts = meow_message.split()
+        decoded_message = []
+
+        for part in meow_parts:
+            if part in self.decoding_map:
+                decoded_message.append(self.decoding_map[part] + ' ')
+            else:
+                decoded_message.append(part)
+        return ''.join(decoded_message)
+
+def random_text(size):
+    # Mostly letters and spaces like a pasted message, with some punctuation, digits and non-ASCII
+    alphabet = string.ascii_letters * 4 + ' ' * 30 + string.punctuation + string.digits + 'éßñ€🐈'
+    return ''.join(random.choices(alphabet, k=size))
+
+def best(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+def main():
+    old = OldMeowEncoderDecoder()
+    new = MeowEncoderDecoder()
+    print(f"{'size':>8} | {'encode old':>11} {'encode new':>11} {'speedup':>7} | {'decode old':>11} {'decode new':>11} {'speedup':>7} | {'chunked':>9}")
+    for size in [int(arg) for arg in sys.argv[1:]] or [1024, 10 * 1024, 100 * 1024, 1024 * 1024]:
+        text = random_text(size)
+        encoded = old.encode_message(text)
+        assert new.encode_message(text) == encoded
+        assert new.decode_message(encoded) == old.decode_message(encoded)
+        chunks = list(new.encode_chunks(text))
+        assert all(len(chunk) <= 2000 for chunk in chunks)
+        assert ''.join(new.decode_message(chunk) for chunk in chunks) == new.decode_message(encoded)
+        # decode_chunks takes the encoded text split anywhere, e.g. in the middle of a code
+        pieces = [encoded[start:start + 1999] for start in range(0, len(encoded), 1999)]
+        assert ''.join(new.decode_chunks(pieces)) == new.decode_message(encoded)
+
+        number = max(1, 2 * 1024 * 1024 // size)
+        encode_old = best(lambda: old.encode_message(text), number)
+        encode_new = best(lambda: new.encode_message(text), number)
+        decode_old = best(lambda: old.decode_message(encoded), number)
+        decode_new = best(lambda: new.decode_message(encoded), number)
+        chunked = best(lambda: sum(1 for _ in new.encode_chunks(text)), number)
+        print(f"{size:>8} | {encode_old * 1e3:9.3f}ms {encode_new * 1e3:9.3f}ms {encode_old / encode_new:6.2f}x | "
+              f"{decode_old * 1e3:9.3f}ms {decode_new * 1e3:9.3f}ms {decode_old / decode_new:6.2f}x | {chunked * 1e3:7.3f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import music
+from music import GuildPlayer, PlayerRegistry, TimerHeap, Track
+from utils import LatencyHistogram, LoopLagMonitor
+
+# Simulated load test for the per-guild music players: N guilds play their queues at the same time
+# through one PlayerRegistry and one TimerHeap, with fake voice clients, channels and extraction.
+# Fake voice clients "play" each track on their own thread for --play seconds and then call the
+# after callback, like discord.py's audio player thread does.
+#   python bench/music_load.py --guilds 300 --songs 3 --play 0.5
+
+class FakeSource:
+    def __init__(self, url, **kwargs):
+        self.url = url
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+    def __init__(self, load):
+        self.load = load
+        self.connected = True
+        self.playing = False
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self.playing
+
+    def play(self, source, after):
+        self.playing = True
+        self.load.started()
+
+        def run():
+            time.sleep(self.load.play_seconds)
+            self.playing = False
+            self.load.finished()
+            after(None)
+        threading.Thread(target=run, daemon=True).start()
+
+
+class FakeMessage:
+    def __init__(self, load):
+        self.load = load
+
+    async def edit(self, content):
+        self.load.counts["playbar edits"] += 1
+
+
+class FakeChannel:
+    def __init__(self, load, channel_id):
+        self.load = load
+        self.id = channel_id
+
+    async def connect(self):
+        await asyncio.sleep(0.01)
+        return FakeVoiceClient(self.load)
+
+    async def send(self, text):
+        self.load.counts["messages"] += 1
+        return FakeMessage(self.load)
+
+
+class FakeExtractor:
+    # Answers like Extractor.extract after `latency` seconds, as if yt-dlp ran on a worker thread
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    async def extract(self, url, need_stream=True):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return {'id': url, 'title': url, 'uploader': 'Load Test', 'duration': 60, 'url': f'https://stream.invalid/{url}', 'entries': None}
+
+
+class Load:
+    def __init__(self, play_seconds):
+        self.play_seconds = play_seconds
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.playing = 0
+        self.peak = 0
+
+    def started(self):
+        with self.lock:
+            self.playing += 1
+            self.peak = max(self.peak, self.playing)
+
+    def finished(self):
+        with self.lock:
+            self.playing -= 1
+            self.counts["tracks played"] += 1
+
+
+async def main(guilds, songs, play_seconds, extract_latency):
+    # The only patch: FFmpeg is replaced by a source that spawns nothing
+    music.discord.FFmpegPCMAudio = FakeSource
+    load = Load(play_seconds)
+    extractor = FakeExtractor(extract_latency)
+    timers = TimerHeap()
+    gap_latency = LatencyHistogram()
+    playbar_stats = Counter()
+    registry = PlayerRegistry(lambda guild_id: GuildPlayer(guild_id, extractor, {}, gap_latency, timers=timers,
+                                                           playbar_stats=playbar_stats), idle_timeout=0)
+    lag = LoopLagMonitor(interval=0.05)
+    lag.start()
+    timers.start()
+
+    async def start_guild(guild_id):
+        player = registry.get(guild_id)
+        player.voice_channel = player.text_channel = FakeChannel(load, guild_id)
+        player.enqueue([Track(f'{guild_id}-{song}', f'Song {song}', 'Load Test', 60) for song in range(songs)])
+        await player.play_next()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(start_guild(guild_id) for guild_id in range(guilds)))
+    # A player between tracks holds its lock while it resolves the next one
+    while any(player.is_playing() or player.playlist or player.lock.locked() for player in registry.players.values()):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    timers.stop()
+    lag.stop()
+
+    for player in registry.players.values():
+        player.voice_client.connected = False
+    registry.evict_idle()
+
+    serial = guilds * songs * play_seconds
+    print(f"{guilds} guilds x {songs} songs of {play_seconds}s: {load.counts['tracks played']} tracks in {elapsed:.2f}s "
+          f"(one shared queue would take {serial:.0f}s), peak {load.peak} playing at once")
+    print(f"now-playing messages={load.counts['messages']} extractions={extractor.calls} players left after eviction={len(registry)}")
+    print(f"gap between tracks: {gap_latency.summary()}")
+    print(f"event loop lag: {lag.histogram.summary()}")
+    assert load.counts["tracks played"] == guilds * songs
+    assert len(registry) == 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated N-guild music load test")
+    parser.add_argument("--guilds", type=int, default=300)
+    parser.add_argument("--songs", type=int, default=3)
+    parser.add_argument("--play", type=float, default=0.5, help="seconds each fake track plays")
+    parser.add_argument("--extract-latency", type=float, default=0.01)
+    args = parser.parse_args()
+    asyncio.run(main(args.guilds, args.songs, args.play, args.extract_latency))
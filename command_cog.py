@@ -1,12 +1,16 @@
-from utils import MeowEncoderDecoder, ConfigLoader
+from utils import MeowEncoderDecoder, LRUCache, LatencyHistogram
+from image_feed import ImageFeed
+from fact_store import FactStore
+from audio_cache import AudioCache
+from database import Database
+from playlist_store import MongoPlaylistStore, SQLitePlaylistStore, encode_track, decode_track
+from music import Extractor, GuildPlayer, PlayerRegistry, TimerHeap, Track, format_duration
+import time
+from collections import Counter, OrderedDict
 import os
 import asyncio
-import random
 import discord
-import yt_dlp as youtube_dl
-import requests
-from bs4 import BeautifulSoup
-from datetime import datetime, timedelta
+import aiohttp
 from discord.ext import commands, tasks
 encoder_decoder = MeowEncoderDecoder()
 
@@ -15,64 +19,86 @@ class Commands_Cog(commands.Cog, name="Commands"):
         self.bot = bot
         self.config_directory = config_directory
         self.facts_directory = facts_directory
-        self.last_encoded_message = None
-        self.last_decoded_message = None
+        # Results keyed by (operation, text), and the last text each channel asked for
+        self.codec_cache = LRUCache(512)
+        self.recent_requests = OrderedDict()
+        self.duplicate_window = 30
+        self.cat_images = ImageFeed("https://cataas.com/cat?html=true")
+        # videos.json lives next to facts.json
+        self.facts = FactStore(facts_directory, "facts")
+        self.videos = FactStore(os.path.join(os.path.dirname(facts_directory), "videos.json"), "videos")
+
+    async def cog_load(self):
+        self.cat_images.start()
+
+    async def cog_unload(self):
+        await self.cat_images.close()
+
+    def is_duplicate(self, channel_id, operation, text):
+        # The same text asked for again in the same channel shortly after is ignored
+        key = (channel_id, operation)
+        now = time.monotonic()
+        previous = self.recent_requests.pop(key, None)
+        self.recent_requests[key] = (text, now)
+        if len(self.recent_requests) > 10000:
+            self.recent_requests.popitem(last=False)
+        return previous is not None and previous[0] == text and now - previous[1] < self.duplicate_window
 
     @commands.command()
     async def encode(self, ctx, *words):
-        to_encode = ""
-        for word in words:
-            to_encode = to_encode + word + " "
+        to_encode = " ".join(words) + " "
 
-        if to_encode != self.last_encoded_message:
-            encoded_message = encoder_decoder.encode_message(to_encode)
-            await ctx.send(encoded_message)
-            self.last_encoded_message = to_encode
+        if not self.is_duplicate(ctx.channel.id, "encode", to_encode):
+            # Long messages encode to more than Discord allows in one message
+            pieces = self.codec_cache.get_or_compute(("encode", to_encode), lambda: tuple(encoder_decoder.encode_chunks(to_encode)))
+            for piece in pieces:
+                await ctx.send(piece)
 
     @commands.command()
     async def decode(self, ctx, *words):
-        to_decode = ""
-        for word in words:
-            to_decode = to_decode + word + " "
+        to_decode = " ".join(words) + " "
 
-        if to_decode != self.last_decoded_message:
-            decoded_message = encoder_decoder.decode_message(to_decode)
+        if not self.is_duplicate(ctx.channel.id, "decode", to_decode):
+            decoded_message = self.codec_cache.get_or_compute(("decode", to_decode), lambda: encoder_decoder.decode_message(to_decode))
             await ctx.send(decoded_message)
-            self.last_decoded_message = to_decode
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def codecstats(self, ctx):
+        await ctx.send(f"``encode/decode cache: {self.codec_cache.stats_report()}``")
 
     @commands.command(alias=['car'])
     async def randomcar(self, ctx):
-        base_url = "https://cataas.com/cat?html=true"
-
         try:
-            response = requests.get(base_url)
-            response.raise_for_status()
-
-            soup = BeautifulSoup(response.content, "html.parser")
-            img_element = soup.find("img")
+            image_url = await self.cat_images.get()
 
-            if img_element:
-                image_url = img_element["src"]
+            if image_url:
                 await ctx.send(image_url)
             else:
                 await ctx.send("Sorry, couldn't find an image in the response")
 
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             print(f"An error occurred fetching a cat image: {e}")
             await ctx.send("Sorry, there was an error fetching a cat image")
 
     @commands.command()
     async def carfact(self, ctx):
-        facts = ConfigLoader(self.facts_directory).load_config()
+        fact = await self.facts.draw()
+
+        await ctx.send(fact or "No car facts right now")
+
+    @commands.command()
+    async def carvideo(self, ctx):
+        video = await self.videos.draw()
 
-        await ctx.send(random.choice(facts["facts"]))
+        await ctx.send(video or "No car videos right now")
 
     async def setup(self, bot):
         await bot.add_cog(self)
 
 
 class Music_Cog(commands.Cog, name="Music"):
-    def __init__(self, bot):
+    def __init__(self, bot, audio_cache_mb=0, mongo_uri=None, playlist_db='playlists.db'):
         self.bot = bot
         self.ydl_opts = {
             'format': 'bestaudio/best',
@@ -90,17 +116,28 @@ class Music_Cog(commands.Cog, name="Music"):
             'options': '-vn'
         }
 
-        self.current_message = None
-        self.current_start_time = None
-        self.current_duration = None
-        self.current_title = None
-        self.current_artist = None
-        self.song_queue = asyncio.Queue()
-        self.current_song_info = None
         self.time_cap = 10 * 60
-
-        self.check_empty_vc.start()
-        self.update_playbar.start()
+        self.idle_timeout = 60
+        self.extractor = Extractor(self.ydl_opts)
+        # Time from one track ending to the next one starting, across all guilds
+        self.gap_latency = LatencyHistogram()
+        # One timer heap drives the playbar edits and idle disconnects of every guild
+        self.timers = TimerHeap()
+        self.playbar_stats = Counter()
+        # Tracks played repeatedly are kept as Opus files when a cache size is configured
+        self.audio_cache = AudioCache('downloads', audio_cache_mb * 2 ** 20) if audio_cache_mb > 0 else None
+        # Every guild gets its own queue and now-playing state
+        self.players = PlayerRegistry(lambda guild_id: GuildPlayer(guild_id, self.extractor, self.ffmpeg_opts, self.gap_latency,
+                                                                   timers=self.timers, playbar_stats=self.playbar_stats,
+                                                                   audio_cache=self.audio_cache))
+
+        # Saved playlists and queue checkpoints, in Mongo when it is configured
+        self.store = MongoPlaylistStore(Database(mongo_uri, pool_size=2)) if mongo_uri else SQLitePlaylistStore(playlist_db)
+        # Guild id -> (playlist version, current track) of the last saved checkpoint
+        self.checkpoints = {}
+
+        self.timers.start()
+        self.evict_idle_players.start()
 
 
     @commands.command()
@@ -118,86 +155,50 @@ class Music_Cog(commands.Cog, name="Music"):
             await ctx.send('You need to join the voice channel first!')
             return
 
-        # Connect to the voice channel if not already connected
-        """
-        if not ctx.voice_client or not ctx.voice_client.is_connected():
-            vc = await channel.connect()
-        else:
-            vc = ctx.voice_client
-        """
-
-
-
-        with youtube_dl.YoutubeDL(self.ydl_opts) as ydl:
-            info = ydl.extract_info(song_url, download=False)
-            title = info.get('title', 'Unknown Title')
-            artist = info.get('uploader', 'Unknown Artist')
-            duration = info.get('duration', 0)
-
-        if duration > self.time_cap:
-            await ctx.send(f'The video ``{title}`` is too long ({self.format_duration(duration)}). Maximum allowed duration is 10 minutes.')
-            return
-
-        await self.song_queue.put((ctx, channel, song_url, title, artist))
-
-        await ctx.send(f'Added to queue: ``{title}`` by ``{artist}``')
-
-        if not ctx.voice_client or not ctx.voice_client.is_playing():
-            await self.play_next_song()
-
-    async def play_next_song(self):
-        # Play the music
-
-        if self.song_queue.empty():
+        # Extraction runs off the event loop, and play_next reuses the result from the cache. The
+        # link may be a playlist, so a stream URL is not required here
+        info = await self.extractor.extract(song_url, need_stream=False)
+        if info is None:
+            await ctx.send(f'Could not load ``{song_url}``')
             return
-
-        ctx, channel, song_url, title, artist = await self.song_queue.get()
-
-        if not ctx.voice_client or not ctx.voice_client.is_connected():
-            vc = await channel.connect()
+        player = self.players.get(ctx.guild.id)
+        player.voice_channel = channel
+        player.text_channel = ctx.channel
+
+        if info['entries'] is not None:
+            # A playlist is queued in one go, each track is extracted when its turn comes
+            tracks = [Track(url, title, artist, duration, ctx.author.id)
+                      for url, title, artist, duration in info['entries'] if duration <= self.time_cap]
+            player.enqueue(tracks)
+            skipped = len(info['entries']) - len(tracks)
+            await ctx.send(f'Added {len(tracks)} songs from ``{info["title"]}`` to the queue' + (f', skipped {skipped} longer than 10 minutes' if skipped else ''))
         else:
-            vc = ctx.voice_client
-
-        with youtube_dl.YoutubeDL(self.ydl_opts) as ydl:
-            info = ydl.extract_info(song_url, download=False)
-            url2 = info['url']
-            duration = info.get('duration', 0)
-            file_path = ydl.prepare_filename(info)
-
-            self.current_duration = duration
-            self.current_start_time = datetime.now()
-            self.current_title = title
-            self.current_artist = artist
-            self.current_song_info = (title, artist, file_path)
-
-
-
+            title = info['title']
+            artist = info['uploader']
+            duration = info['duration']
 
-            vc.play(discord.FFmpegPCMAudio(url2, **self.ffmpeg_opts), after=lambda e: self.bot.loop.create_task(self.song_finished(ctx)))
-
-        playbar_message = await ctx.send(f'Now playing: ``{title}``\n By: ``{artist}``\n **{"—" * 30}** ``[0:00/{self.format_duration(duration)}]``')
-        self.current_message = playbar_message
-        #await ctx.send(f'Now playing: {info["title"]}')
+            if duration > self.time_cap:
+                await ctx.send(f'The video ``{title}`` is too long ({format_duration(duration)}). Maximum allowed duration is 10 minutes.')
+                return
 
-    async def song_finished(self, ctx):
-        if self.current_song_info:
-            file_path = self.current_song_info[2]
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            player.enqueue([Track(song_url, title, artist, duration, ctx.author.id)])
+            await ctx.send(f'Added to queue: ``{title}`` by ``{artist}``')
 
-        self.current_song_info = None
-        await self.play_next_song()
+        if not player.is_playing():
+            await player.play_next()
 
     @commands.command()
     async def pause(self, ctx):
         if ctx.voice_client and ctx.voice_client.is_playing():
             ctx.voice_client.pause()
+            self.players.get(ctx.guild.id).pause()
             await ctx.send('Paused the current song.')
 
     @commands.command()
     async def resume(self, ctx):
         if ctx.voice_client and ctx.voice_client.is_paused():
             ctx.voice_client.resume()
+            self.players.get(ctx.guild.id).resume()
             await ctx.send('Resumed the current song,')
 
     @commands.command()
@@ -207,74 +208,212 @@ class Music_Cog(commands.Cog, name="Music"):
             await ctx.send('Skipped the current song.')
 
     @commands.command()
-    async def queue(self, ctx):
-        if self.song_queue.empty():
+    async def queue(self, ctx, page: int = 1):
+        player = self.players.find(ctx.guild.id)
+        if player is None or not player.playlist:
             await ctx.send('The queue is empty.')
             return
 
-        queue_list = list(self.song_queue._queue)
-        current_song = f"> Now playing: {self.current_title} by {self.current_artist}\n"
+        per_page = 10
+        pages = (len(player.playlist) - 1) // per_page + 1
+        page = min(max(page, 1), pages)
+        current = player.current
+        current_song = f"> Now playing: {current.title} by {current.artist}\n" if current else ""
         upcoming_songs = "\n".join(
-            [f"``{i + 1}``. **{title}** by **{artist}**" for i, (ctx, channel, url, title, artist) in enumerate(queue_list)])
-        await ctx.send(current_song + "Upcoming songs:\n" + upcoming_songs)
+            [f"``{position}``. **{track.title}** by **{track.artist}**" for position, entry_id, track in player.playlist.page((page - 1) * per_page, per_page)])
+        await ctx.send(current_song + f"Upcoming songs (page {page}/{pages}):\n" + upcoming_songs)
 
     @commands.command()
-    async def remove(self, ctx, index: int):
-        queue_list = list(self.song_queue._queue)
-        if 0 <= index < len(queue_list):
-            del queue_list[index]
-            self.song_queue = asyncio.Queue()
-            for item in queue_list:
-                await self.song_queue.put(item)
-            await ctx.send(f'Removed song at position {index + 1} from the queue')
+    async def remove(self, ctx, position: int):
+        # Positions are the numbers shown by the queue command
+        player = self.players.find(ctx.guild.id)
+        track = player.playlist.remove_at(position - 1) if player else None
+        if track:
+            player.queue_changed()
+            await ctx.send(f'Removed ``{track.title}`` at position {position} from the queue')
         else:
-            await ctx.send(f'No song at position {index + 1} in the queue')
-
-    @tasks.loop(seconds=1)
-    async def update_playbar(self):
-        if self.current_message and self.current_start_time and self.current_duration:
-            elapsed_time = (datetime.now() - self.current_start_time).seconds
-            if elapsed_time > self.current_duration:
-                self.current_message = None
-                self.current_start_time = None
-                self.current_duration = None
-                self.current_title = None
-                self.current_artist = None
-                return
+            await ctx.send(f'No song at position {position} in the queue')
+
+    @commands.command()
+    async def move(self, ctx, position: int, new_position: int):
+        player = self.players.find(ctx.guild.id)
+        track = player.playlist.move(position - 1, new_position - 1) if player else None
+        if track:
+            player.queue_changed()
+            await ctx.send(f'Moved ``{track.title}`` to position {new_position}')
+        else:
+            await ctx.send('Both positions need to be in the queue')
+
+    @commands.command()
+    async def shuffle(self, ctx):
+        player = self.players.find(ctx.guild.id)
+        if player is None or not player.playlist:
+            await ctx.send('The queue is empty.')
+            return
+        player.playlist.shuffle()
+        player.queue_changed()
+        await ctx.send(f'Shuffled {len(player.playlist)} songs')
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def musicstats(self, ctx):
+        await ctx.send(f"``{len(self.players)} guild players, gap between tracks: {self.gap_latency.summary()}\n"
+                       f"playbar edits: sent={self.playbar_stats['sent']} skipped={self.playbar_stats['skipped']} "
+                       f"rate_limited={self.playbar_stats['rate_limited']} failed={self.playbar_stats['failed']}\n"
+                       f"{self.extractor.stats_report()}"
+                       + (f"\naudio cache: {self.audio_cache.stats_report()}" if self.audio_cache else "") + "``")
+
+    @commands.group(invoke_without_command=True)
+    async def playlist(self, ctx):
+        await ctx.send('Usage: ``-playlist save <name>``, ``-playlist load <name>``, ``-playlist list``, ``-playlist delete <name>``')
+
+    @playlist.command(name='save')
+    async def playlist_save(self, ctx, *, name: str):
+        # Saves the current song and the queue
+        player = self.players.find(ctx.guild.id)
+        tracks = []
+        if player:
+            tracks = ([player.current] if player.current else []) + list(player.playlist)
+        if not tracks:
+            await ctx.send('The queue is empty.')
+            return
+        await self.store.save_playlist(ctx.guild.id, ctx.author.id, name, [encode_track(track) for track in tracks])
+        await ctx.send(f'Saved {len(tracks)} songs as ``{name}``')
 
-            playbar = self.create_playbar(elapsed_time, self.current_duration)
-            await self.current_message.edit(content=playbar)
+    @playlist.command(name='load')
+    async def playlist_load(self, ctx, *, name: str):
+        if not ctx.author.voice or not ctx.author.voice.channel:
+            await ctx.send('You need to join the voice channel first!')
+            return
+        entries = await self.store.load_playlist(ctx.guild.id, ctx.author.id, name)
+        if entries is None:
+            await ctx.send(f'You have no playlist named ``{name}``')
+            return
 
-    def create_playbar(self, elapsed, duration):
-        elapsed_str = self.format_duration(elapsed)
-        duration_str = self.format_duration(duration)
-        bar_length = 30
-        progress = int(bar_length * (elapsed / duration))
-        playbar = f'{"=" * progress}{"-" * (bar_length - progress)}'
-        return f'Now playing: ``{self.current_title}``\n``{self.current_artist}``\n**{playbar}** ``[{elapsed_str}/{duration_str}]``'
+        # Queued straight from the stored metadata, each track is extracted when its turn comes
+        player = self.players.get(ctx.guild.id)
+        player.voice_channel = ctx.author.voice.channel
+        player.text_channel = ctx.channel
+        player.enqueue([decode_track(entry, ctx.author.id) for entry in entries])
+        await ctx.send(f'Added {len(entries)} songs from ``{name}`` to the queue')
+
+        if not player.is_playing():
+            await player.play_next()
+
+    @playlist.command(name='list')
+    async def playlist_list(self, ctx):
+        playlists = await self.store.list_playlists(ctx.guild.id, ctx.author.id)
+        if not playlists:
+            await ctx.send('You have no playlists.')
+            return
+        await ctx.send("Your playlists:\n" + "\n".join(f"**{name}** ({count} songs)" for name, count in playlists))
 
-    def format_duration(self, seconds):
-        minutes, seconds = divmod(seconds, 60)
-        return f'{minutes}:{seconds:02d}'
+    @playlist.command(name='delete')
+    async def playlist_delete(self, ctx, *, name: str):
+        if await self.store.delete_playlist(ctx.guild.id, ctx.author.id, name):
+            await ctx.send(f'Deleted ``{name}``')
+        else:
+            await ctx.send(f'You have no playlist named ``{name}``')
+
+    async def cog_load(self):
+        if self.audio_cache:
+            await self.audio_cache.load()
+        await self.resume_queues()
+        self.checkpoint_queues.start()
+
+    async def cog_unload(self):
+        self.checkpoint_queues.cancel()
+        # One last checkpoint so a restart resumes from here
+        await self.checkpoint_queues()
+        self.timers.stop()
+        self.evict_idle_players.cancel()
+        self.extractor.close()
+        if self.audio_cache:
+            await self.audio_cache.close()
+        self.store.close()
+
+    async def resume_queues(self):
+        try:
+            states = await self.store.load_queues()
+        except Exception as e:
+            print(f"Could not load the queue checkpoints: {e}")
+            return
+
+        for state in states:
+            # Checkpoints of guilds that cannot be resumed are deleted by the next checkpoint
+            self.checkpoints[state["guild_id"]] = None
+            guild = self.bot.get_guild(state["guild_id"])
+            voice_channel = guild.get_channel(state["voice_channel_id"]) if guild else None
+            text_channel = guild.get_channel(state["text_channel_id"]) if guild else None
+            if voice_channel is None or text_channel is None or not state["tracks"]:
+                continue
+
+            tracks = [decode_track(entry) for entry in state["tracks"]]
+            tracks[0].offset = state.get("offset", 0)
+            player = self.players.get(guild.id)
+            player.voice_channel = voice_channel
+            player.text_channel = text_channel
+            player.enqueue(tracks)
+            # Only rejoin a channel someone is still listening in, otherwise the queue just waits
+            if any(not member.bot for member in voice_channel.members):
+                self.bot.loop.create_task(player.play_next())
+
+    @tasks.loop(seconds=30)
+    async def checkpoint_queues(self):
+        # Playing guilds are saved every time so the position stays current, others only on change
+        states, removed = [], []
+        for guild_id, player in list(self.players.players.items()):
+            state = player.checkpoint()
+            if state is None:
+                if guild_id in self.checkpoints:
+                    del self.checkpoints[guild_id]
+                    removed.append(guild_id)
+                continue
+            signature = (player.playlist.version, id(player.current))
+            if player.current is not None or self.checkpoints.get(guild_id) != signature:
+                state["tracks"] = [encode_track(track) for track in state["tracks"]]
+                states.append(state)
+                self.checkpoints[guild_id] = signature
+        for guild_id in [guild_id for guild_id in self.checkpoints if guild_id not in self.players.players]:
+            del self.checkpoints[guild_id]
+            removed.append(guild_id)
+
+        try:
+            await self.store.save_queues(states, removed)
+        except Exception as e:
+            print(f"Could not checkpoint the music queues: {e}")
 
     @tasks.loop(seconds=60)
-    async def check_empty_vc(self):
-        for vc in self.bot.voice_clients:
-            if len(vc.channel.members) == 1:
-                await asyncio.sleep(60)
-                if len(vc.channel.members) == 1:
-                    await vc.disconnect()
+    async def evict_idle_players(self):
+        self.players.evict_idle()
 
     @commands.Cog.listener()
-    async def on_state_update(self, member, before, after):
-        if not before.channel:
+    async def on_voice_state_update(self, member, before, after):
+        # Mute and deafen changes keep the channel the same
+        if before.channel == after.channel:
             return
-
-        voice_client = discord.utils.get(self.bot.voice_clients, guild=before.channel.guild)
-        if voice_client and len(voice_client.channel.members) == 1:
-            await asyncio.sleep(60)
-            if len(voice_client.channel.members) == 1:
-                await voice_client.disconnect()
+        voice_client = member.guild.voice_client
+        key = ("idle", member.guild.id)
+        if voice_client is None or not voice_client.is_connected():
+            self.timers.cancel(key)
+        elif self.is_alone(voice_client):
+            # Leave if nobody comes back within idle_timeout seconds
+            if key not in self.timers:
+                self.timers.schedule(key, self.idle_timeout, lambda: self.disconnect_if_alone(member.guild.id))
+        else:
+            self.timers.cancel(key)
+
+    def is_alone(self, voice_client):
+        return not any(not member.bot for member in voice_client.channel.members)
+
+    async def disconnect_if_alone(self, guild_id):
+        guild = self.bot.get_guild(guild_id)
+        voice_client = guild.voice_client if guild else None
+        if voice_client and voice_client.is_connected() and self.is_alone(voice_client):
+            player = self.players.find(guild_id)
+            if player:
+                player.stop()
+            await voice_client.disconnect()
 
     async def setup(self, bot):
         await bot.add_cog(self)
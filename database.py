@@ -0,0 +1,90 @@
+import asyncio
+import functools
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, ReturnDocument
+from utils import LatencyHistogram
+
+class AsyncCollection:
+    # Runs blocking pymongo calls on a bounded thread pool so the event loop never waits on Mongo
+    def __init__(self, database, collection):
+        self.database = database
+        self.collection = collection
+        self.name = collection.name
+
+    async def run(self, op, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.database.executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self.database.latency[f"{self.name}.{op}"].record(time.perf_counter() - start)
+
+    async def find_one(self, filter, projection=None):
+        return await self.run("find_one", self.collection.find_one, filter, projection)
+
+    async def find(self, filter=None, projection=None, sort=None, limit=0):
+        # Cursors are drained inside the worker thread since iterating them is also network I/O
+        def fetch():
+            cursor = self.collection.find(filter or {}, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            if limit:
+                cursor = cursor.limit(limit)
+            return list(cursor)
+        return await self.run("find", fetch)
+
+    async def insert_one(self, document):
+        return await self.run("insert_one", self.collection.insert_one, document)
+
+    async def update_one(self, filter, update, upsert=False):
+        return await self.run("update_one", self.collection.update_one, filter, update, upsert=upsert)
+
+    async def update_many(self, filter, update):
+        return await self.run("update_many", self.collection.update_many, filter, update)
+
+    async def find_one_and_update(self, filter, update, upsert=False, after=True, projection=None):
+        return_document = ReturnDocument.AFTER if after else ReturnDocument.BEFORE
+        return await self.run("find_one_and_update", self.collection.find_one_and_update, filter, update,
+                              projection=projection, upsert=upsert, return_document=return_document)
+
+    async def delete_one(self, filter):
+        return await self.run("delete_one", self.collection.delete_one, filter)
+
+    async def bulk_write(self, requests, ordered=True):
+        return await self.run("bulk_write", self.collection.bulk_write, requests, ordered=ordered)
+
+    async def count_documents(self, filter):
+        return await self.run("count_documents", self.collection.count_documents, filter)
+
+    async def create_index(self, keys, **kwargs):
+        return await self.run("create_index", self.collection.create_index, keys, **kwargs)
+
+
+class Database:
+    def __init__(self, mongo_uri=None, name="users", pool_size=8, max_pool_size=50, client=None):
+        # Any pymongo-compatible client works here, e.g. mongomock.MongoClient() for local benchmarks
+        self.client = client or MongoClient(mongo_uri, maxPoolSize=max_pool_size)
+        self.db = self.client[name]
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="mongo")
+        self.latency = defaultdict(LatencyHistogram)
+
+    async def call(self, func, *args):
+        # Runs a blocking function that takes the pymongo database, e.g. index maintenance
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, func, self.db, *args)
+        finally:
+            self.latency[func.__name__].record(time.perf_counter() - start)
+
+    def collection(self, name):
+        return AsyncCollection(self, self.db[name])
+
+    def latency_report(self):
+        return "\n".join(f"{op}: {histogram.summary()}" for op, histogram in sorted(self.latency.items()))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.client.close()
@@ -1,125 +1,197 @@
 import discord
-import json
+import asyncio
 from discord.ext import commands, tasks
-from pymongo import MongoClient
+from pymongo import UpdateOne
+from database import Database
+from leaderboard import Leaderboard
+from schema import ensure_indexes, audit_queries
+from shop import CatalogStore
+from user_cache import UserCache, Transaction
 from datetime import datetime, timedelta
-from utils import simulate_stock_price, load_initial_stocks
+from stock_engine import StockEngine, QuoteTable
+from utils import load_initial_stocks, file_digest, LoopLagMonitor
+
+MARKET_UNAVAILABLE = "The stock market is not available right now, try again later."
 
 class StockMarket:
-    def __init__(self, economy_cog, stock_file, min_investment):
+    def __init__(self, economy_cog, stock_file, min_investment, model="gbm"):
         self.economy_cog = economy_cog
         self.stock_file = stock_file
         self.min_investment = min_investment
-        self.update_stocks.start()
+        self.engine = StockEngine(economy_cog.stocks, economy_cog.stock_history, economy_cog.quotes, model=model,
+                                  interval_minutes=self.update_stocks.minutes)
 
     # Updates the stocks every 15 minutes to simulate market volatility
     @tasks.loop(minutes=15)
     async def update_stocks(self):
-        all_stocks = self.economy_cog.get_all_stock_symbols()
-        for symbol in all_stocks:
-            stock_data = self.economy_cog.get_stock_price(symbol)
-            if stock_data is not None:
-                current_price = stock_data["price"]
-                new_price = simulate_stock_price(current_price)
-                self.economy_cog.update_stock_price(symbol, new_price)
-
-    def invest(self, user_id, symbol, amount):
+        await self.engine.tick()
+
+    async def invest(self, user_id, symbol, amount):
         if amount < self.min_investment:
             return f"The minimum investment is ${self.min_investment}."
 
-        stock_price = self.economy_cog.get_stock_price(symbol)
+        if not await self.economy_cog.wait_for_market():
+            return MARKET_UNAVAILABLE
+        stock_price = await self.economy_cog.get_stock_price(symbol)
         if stock_price is None:
             return "Invalid stock symbol or unable to fetch stock data."
 
         shares = amount / stock_price
-        self.economy_cog.update_user_balance(user_id, -amount)
-        self.economy_cog.add_to_stock_portfolio(user_id, symbol, shares)
+        transaction = self.economy_cog.transaction()
+        transaction.debit(user_id, "balance", amount)
+        transaction.credit(user_id, f"portfolio.{symbol}", shares)
+        if await transaction.commit() is None:
+            return "You don't have enough money to invest that much."
         return f"You have invested ${amount} in {symbol}. You now own {shares:.2f} shares."
 
-    # Add all values of stocks in portfolio
-    def get_portfolio_value(self, user_id):
-        portfolio = self.economy_cog.get_stock_portfolio(user_id)
-        total_value = 0
-        for symbol, shares in portfolio.items():
-            stock_price = self.economy_cog.get_stock_price(symbol)
-            total_value += shares * stock_price
-        return total_value
+    # Add all values of stocks in portfolio, all priced from the same tick. Callers check
+    # wait_for_market() first
+    async def get_portfolio_value(self, user_id):
+        portfolio = await self.economy_cog.get_stock_portfolio(user_id)
+        prices = self.economy_cog.quotes.snapshot.prices
+        return sum(shares * prices.get(symbol, 0) for symbol, shares in portfolio.items())
 
 class Economy_Cog(commands.Cog):
-    def __init__(self, bot, mongo_uri, shop_file, stock_file, min_investment):
+    def __init__(self, bot, mongo_uri, shop_file, stock_file, min_investment, pool_size=8, max_pool_size=50, mongo_client=None,
+                 cache_size=10000, flush_interval_ms=500, flush_ops=100, stock_model="gbm", pending_trade_ttl=24 * 60 * 60):
         self.bot = bot
-        self.client = MongoClient(mongo_uri)
-        self.db = self.client["users"]
-        self.users = self.db["users"]
-        self.stocks = self.db["stocks"]
-        self.trades = self.db["trades"]
+        # All Mongo access goes through the async layer, pool_size bounds the worker threads doing blocking I/O
+        self.database = Database(mongo_uri, pool_size=pool_size, max_pool_size=max_pool_size, client=mongo_client)
+        self.users = self.database.collection("users")
+        self.stocks = self.database.collection("stocks")
+        self.trades = self.database.collection("trades")
+        self.meta = self.database.collection("meta")
+        self.stock_history = self.database.collection("stock_history")
+        self.quotes = QuoteTable()
+        # Reads are served from the cache and writes are coalesced into periodic bulk writes
+        defaults = {"balance": 0, "last_daily": None, "inventory": {}, "portfolio": {}}
+        self.user_cache = UserCache(self.users, defaults, cache_size, flush_interval_ms, flush_ops)
+        self.rankings = Leaderboard(self.users, self.user_cache, self.quotes)
+        self.loop_lag = LoopLagMonitor()
         self.daily_amount = 500
         self.shop_file = shop_file
+        self.stock_file = stock_file
+        self.min_investment = min_investment
+        self.stock_model = stock_model
+        self.pending_trade_ttl = pending_trade_ttl
+        self.stock_market = StockMarket(self, stock_file, min_investment, stock_model)
+        self.market_ready = asyncio.Event()
+        self.startup_task = None
         self.load_shop_items()
-        self.stock_market = StockMarket(self, stock_file, min_investment)
-        self.initialize_stocks(stock_file)
+
+    async def cog_load(self):
+        self.loop_lag.start()
+        self.user_cache.start()
+        # Schema and stock seeding run in the background so the cog is usable right away,
+        # anything that needs prices waits briefly on market_ready through wait_for_market
+        self.startup_task = asyncio.get_running_loop().create_task(self.start_market())
+        self.watch_shop_file.start()
+
+    async def start_market(self, retry_delay=5, max_retry_delay=300):
+        # Retried with backoff until it succeeds, e.g. while Mongo is down or the stocks file is missing
+        while True:
+            try:
+                await self.database.call(ensure_indexes, self.pending_trade_ttl)
+                await self.initialize_stocks(self.stock_file)
+                await self.load_quotes()
+                break
+            except Exception as e:
+                print(f"An error occurred starting the stock market, retrying in {retry_delay}s: {e}")
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, max_retry_delay)
+        self.market_ready.set()
+        self.stock_market.update_stocks.start()
+
+    async def cog_unload(self):
+        if self.startup_task:
+            self.startup_task.cancel()
+        self.stock_market.update_stocks.cancel()
+        self.watch_shop_file.cancel()
+        self.loop_lag.stop()
+        # Durable flush of buffered writes before the pool goes away
+        await self.user_cache.close()
+        self.database.close()
+        try:
+            await self.shop_store.flush()
+        except OSError as e:
+            print(f"An error occurred saving the shop: {e}")
 
     def load_shop_items(self):
-        with open(self.shop_file, 'r') as f:
-            self.shop_items = json.load(f)["items"]
+        self.shop_store = CatalogStore(self.shop_file)
+        self.catalog = self.shop_store.catalog
 
     def save_shop_items(self):
-        with open(self.shop_file, 'w') as f:
-            json.dump({"items": self.shop_items}, f, indent=4)
-
-    def get_user_data(self, user_id):
-        user_data = self.users.find_one({"user_id": user_id})
-        if not user_data:
-            user_data = {"user_id": user_id, "balance": 0, "last_daily": None, "inventory": {}, "portfolio": {}}
-            self.users.insert_one(user_data)
-        return user_data
-
-    def update_user_balance(self, user_id, amount):
-        self.users.update_one({"user_id": user_id}, {"$inc": {"balance": amount}})
-
-    def update_last_daily(self, user_id):
-        self.users.update_one({"user_id": user_id}, {"$set": {"last_daily": datetime.utcnow()}})
-
-    def add_to_inventory(self, user_id, item_name, amount=1):
-        self.users.update_one({"user_id": user_id}, {"$inc": {f"inventory.{item_name}": amount}})
-
-    def remove_from_inventory(self, user_id, item_name, amount=1):
-        user_data = self.get_user_data(user_id)
-        if user_data["inventory"].get(item_name, 0) <= amount:
-            self.users.update_one({"user_id": user_id}, {"$unset": {f"inventory.{item_name}": ""}})
-        else:
-            self.users.update_one({"user_id": user_id}, {"$inc": {f"inventory.{item_name}": -amount}})
-
-    def add_to_stock_portfolio(self, user_id, symbol, shares):
-        self.users.update_one({"user_id": user_id}, {"$inc": {f"portfolio.{symbol}": shares}})
-
-    def get_stock_portfolio(self, user_id):
-        user_data = self.get_user_data(user_id)
+        # Debounced atomic write in the background, several admin edits in a row become one write
+        self.shop_store.schedule_save()
+
+    # Picks up edits made to shopdata.json by hand without restarting the bot
+    @tasks.loop(seconds=30)
+    async def watch_shop_file(self):
+        try:
+            await self.shop_store.reload_if_changed()
+        except Exception as e:
+            print(f"An error occurred reloading the shop: {e}")
+
+    async def get_user_data(self, user_id):
+        return await self.user_cache.get(user_id)
+
+    def transaction(self):
+        # Conditional multi-user changes, e.g. a debit that must not take a balance below zero
+        return Transaction(self.user_cache)
+
+    async def get_stock_portfolio(self, user_id):
+        user_data = await self.get_user_data(user_id)
         return user_data.get("portfolio", {})
 
-    def get_all_stock_symbols(self):
-        return [stock["symbol"] for stock in self.stocks.find()]
-
-    def get_stock_price(self, symbol):
-        stock_data = self.stocks.find_one({"symbol": symbol})
-        return stock_data["price"] if stock_data else None
-
-    def update_stock_price(self, symbol, new_price):
-        self.stocks.update_one({"symbol": symbol}, {"$set": {"price": new_price}}, upsert=True)
-
-    def initialize_stocks(self, stock_file):
-        initial_prices = load_initial_stocks(stock_file)
-        for symbol, price in initial_prices.items():
-            self.update_stock_price(symbol, price)
+    async def load_quotes(self):
+        stocks = await self.stocks.find({}, {"symbol": 1, "price": 1})
+        self.quotes.publish({stock["symbol"]: stock["price"] for stock in stocks if stock.get("price") is not None})
+
+    async def wait_for_market(self, timeout=5):
+        # True once prices are loaded. Commands answer "unavailable" instead of waiting on a market
+        # that is still retrying its startup
+        if self.market_ready.is_set():
+            return True
+        try:
+            await asyncio.wait_for(self.market_ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def get_stock_price(self, symbol):
+        # Prices only change on a market tick, so they are served from the local quote table.
+        # Callers check wait_for_market() first
+        return self.quotes.get(symbol)
+
+    async def initialize_stocks(self, stock_file):
+        # One bulk upsert, skipped entirely if the file is unchanged since it was last seeded.
+        # The file price only applies to new symbols so prices evolved by the market are kept
+        digest = await asyncio.to_thread(file_digest, stock_file)
+        seed = await self.meta.find_one({"_id": "stocks_seed"})
+        if seed and seed.get("hash") == digest:
+            return False
+
+        initial_stocks = await asyncio.to_thread(load_initial_stocks, stock_file)
+        requests = []
+        for symbol, data in initial_stocks.items():
+            update = {"$setOnInsert": {"price": data["price"]}}
+            fields = {key: value for key, value in data.items() if key != "price"}
+            if fields:
+                update["$set"] = fields
+            requests.append(UpdateOne({"symbol": symbol}, update, upsert=True))
+        if requests:
+            await self.stocks.bulk_write(requests, ordered=False)
+        await self.meta.update_one({"_id": "stocks_seed"}, {"$set": {"hash": digest, "seeded_at": datetime.utcnow()}}, upsert=True)
+        return True
 
     @commands.command()
     async def balance(self, ctx):
-        user_data = self.get_user_data(ctx.author.id)
+        user_data = await self.get_user_data(ctx.author.id)
         await ctx.send(f"{ctx.author.mention}, you have ${user_data['balance']}")
 
     @commands.command()
     async def daily(self, ctx):
-        user_data = self.get_user_data(ctx.author.id) # Ensures the data exists
+        user_data = await self.get_user_data(ctx.author.id) # Ensures the data exists
         last_daily = user_data.get("last_daily") 
 
         # If there is a logged date
@@ -132,8 +204,8 @@ class Economy_Cog(commands.Cog):
                 await ctx.send(f"{ctx.author.mention}, you've already claimed your daily reward.")
                 return
 
-        self.update_user_balance(ctx.author.id, self.daily_amount)
-        self.update_last_daily(ctx.author.id)
+        # Applied in one step right after the check so two concurrent claims cannot both pass
+        self.user_cache.apply(ctx.author.id, user_data, inc={"balance": self.daily_amount}, set={"last_daily": datetime.utcnow()})
         await ctx.send(f"{ctx.author.mention}, you have claimed your daily reward of ${self.daily_amount}")
 
     @commands.command()
@@ -142,74 +214,85 @@ class Economy_Cog(commands.Cog):
             await ctx.send("You must give a positive amount.")
             return
 
-        user_data = self.get_user_data(ctx.author.id)
-        if user_data["balance"] < amount:
+        transaction = self.transaction()
+        transaction.debit(ctx.author.id, "balance", amount)
+        transaction.credit(member.id, "balance", amount)
+        if await transaction.commit() is None:
             await ctx.send("You don't have enough money to give.")
             return
 
-        self.update_user_balance(ctx.author.id, -amount)
-        self.update_user_balance(member.id, amount)
         await ctx.send(f"{ctx.author.mention} has given ${amount} to {member.mention}.")
 
     @commands.command()
-    async def leaderboard(self, ctx):
-        leaderboard = self.users.find().sort("balance", -1).limit(10)
-        leaderboard_text = "Leaderboard: \n"
-        for idx, user_data in enumerate(leaderboard):
-            user = self.bot.get_user(user_data["user_id"])
+    async def leaderboard(self, ctx, page: int = 1, metric: str = "balance", scope: str = "global"):
+        if metric not in ("balance", "networth") or scope not in ("global", "server"):
+            await ctx.send("Usage: leaderboard [page] [balance|networth] [global|server]")
+            return
+
+        guild = ctx.guild if scope == "server" else None
+        leaderboard, pages = await self.rankings.page(page, metric, guild)
+        if page < 1 or page > pages:
+            await ctx.send(f"Page number must be between 1 and {pages}")
+            return
+
+        leaderboard_text = f"Leaderboard ({metric}, {scope}) - Page {page}/{pages}: \n"
+        for idx, (user_id, score) in enumerate(leaderboard, start=(page - 1) * self.rankings.per_page):
+            amount = f"{score:.2f}" if metric == "networth" else score
+            user = self.bot.get_user(user_id)
             if user:
-                leaderboard_text += f"**{idx + 1}. {user.name}** - ``${user_data['balance']}``\n"
+                leaderboard_text += f"**{idx + 1}. {user.name}** - ``${amount}``\n"
             else:
-                leaderboard_text += f"{idx + 1}. Unknown User - ${user_data['balance']}\n"
+                leaderboard_text += f"{idx + 1}. Unknown User - ${amount}\n"
         await ctx.send(leaderboard_text)
 
     @commands.command()
     async def shop(self, ctx, page: int = 1):
-        items_per_page = 15
-        pages = (len(self.shop_items) - 1) // items_per_page + 1
+        pages = self.catalog.page_count
         if page < 1 or page > pages:
             await ctx.send(f"Page number must be between 1 and {pages}")
             return
 
-        start = (page - 1) * items_per_page
-        end = start + items_per_page
-        items = self.shop_items[start:end]
-
-        embed = discord.Embed(title="Shop", description=f"Page {page}/{pages}")
-        for item in items:
-            embed.add_field(name=item.get("name", "Unknown"), value=f"Price: ${item.get('price', 'Unknown')}, Type: {item.get('type', 'Unknown')}\nDescription: {item.get('description', 'No description')}", inline=False)
-
-        await ctx.send(embed=embed)
+        await ctx.send(embed=self.catalog.page_embed(page))
 
     @commands.command()
     async def buy(self, ctx, *, item_name: str, amount: int = 1):
-        item = next((item for item in self.shop_items if item["name"].lower() == item_name.lower()), None)
+        item = self.catalog.get(item_name)
         if not item:
-            await ctx.send("Item not found.")
+            await ctx.send(self.catalog.not_found_message(item_name))
             return
 
         total_price = item["price"] * amount
-        user_data = self.get_user_data(ctx.author.id)
-        if user_data["balance"] < total_price:
+        transaction = self.transaction()
+        transaction.debit(ctx.author.id, "balance", total_price)
+
+        if item["type"] == "role":
+            role = discord.utils.get(ctx.guild.roles, id=item["role_id"])
+            if not role:
+                await ctx.send("Role not found in the server.")
+                return
+        elif item["type"] == "product":
+            transaction.credit(ctx.author.id, f"inventory.{item['name']}", amount)
+
+        if await transaction.commit() is None:
             await ctx.send("You don't have enough money to buy this item.")
             return
 
         if item["type"] == "role":
-            role = discord.utils.get(ctx.guild.roles, id=item["role_id"])
-            if role:
+            try:
                 await ctx.author.add_roles(role)
-                await ctx.send(f"You have bought the role {role.name}.")
-            else:
-                await ctx.send("Role not found in the server.")
+            except discord.HTTPException as e:
+                # e.g. Forbidden when the role is above the bot's own, so the purchase is refunded
+                await self.transaction().credit(ctx.author.id, "balance", total_price).commit()
+                await ctx.send(f"Could not give you the role {role.name}, you have been refunded ${total_price}.")
+                print(f"An error occurred adding role {role.name}: {e}")
+                return
+            await ctx.send(f"You have bought the role {role.name}.")
         elif item["type"] == "product":
-            self.add_to_inventory(ctx.author.id, item["name"], amount)
             await ctx.send(f"You have bought {amount} x {item['name']}.")
 
-        self.update_user_balance(ctx.author.id, -total_price)
-
     @commands.command()
     async def inventory(self, ctx):
-        user_data = self.get_user_data(ctx.author.id)
+        user_data = await self.get_user_data(ctx.author.id)
         inventory = user_data.get("inventory", {})
         if not inventory:
             await ctx.send("Your inventory is empty.")
@@ -220,15 +303,9 @@ class Economy_Cog(commands.Cog):
 
     @commands.command()
     async def sell(self, ctx, *, item_name: str, amount: int = 1):
-        user_data = self.get_user_data(ctx.author.id)
-        inventory = user_data.get("inventory", {})
-        if inventory.get(item_name, 0) < amount:
-            await ctx.send("You don't have enough of this item in your inventory.")
-            return
-
-        item = next((item for item in self.shop_items if item["name"].lower() == item_name.lower()), None)
+        item = self.catalog.get(item_name)
         if not item:
-            await ctx.send("Item not found.")
+            await ctx.send(self.catalog.not_found_message(item_name))
             return
 
         if item["type"] == "role":
@@ -236,47 +313,60 @@ class Economy_Cog(commands.Cog):
             return
 
         sell_price = item["price"] * amount // 2
-        self.remove_from_inventory(ctx.author.id, item["name"], amount)
-        self.update_user_balance(ctx.author.id, sell_price)
+        transaction = self.transaction()
+        transaction.debit(ctx.author.id, f"inventory.{item['name']}", amount, drop_empty=True)
+        transaction.credit(ctx.author.id, "balance", sell_price)
+        if await transaction.commit() is None:
+            await ctx.send("You don't have enough of this item in your inventory.")
+            return
+
         await ctx.send(f"You have sold {amount} x {item_name} for ${sell_price}.")
 
     @commands.command()
     async def trade(self, ctx, member: discord.Member, item_name: str, amount: int = 1):
-        user_data = self.get_user_data(ctx.author.id)
-        inventory = user_data.get("inventory", {})
-        if inventory.get(item_name, 0) < amount:
-            await ctx.send("You don't have enough of this item in your inventory.")
-            return
-
-        item = next((item for item in self.shop_items if item["name"].lower() == item_name.lower()), None)
+        item = self.catalog.get(item_name)
         if not item:
-            await ctx.send("Item not found.")
+            await ctx.send(self.catalog.not_found_message(item_name))
             return
 
         if item["type"] == "role":
             await ctx.send("Roles cannot be traded.")
             return
 
+        user_data = await self.get_user_data(ctx.author.id)
+        inventory = user_data.get("inventory", {})
+        if inventory.get(item["name"], 0) < amount:
+            await ctx.send("You don't have enough of this item in your inventory.")
+            return
+
         trade_request = {
             "from_user": ctx.author.id,
             "to_user": member.id,
             "item": item["name"],
             "amount": amount,
-            "status": "pending"
+            "status": "pending",
+            "created_at": datetime.utcnow()
         }
-        self.trades.insert_one(trade_request)
+        await self.trades.insert_one(trade_request)
         await ctx.send(f"{ctx.author.mention} has requested to trade {amount} x {item_name} with {member.mention}. {member.mention}, use `!accept_trade {ctx.author.id}` to accept the trade.")
 
     @commands.command()
     async def accept_trade(self, ctx, from_user_id: int):
-        trade_request = self.trades.find_one({"from_user": from_user_id, "to_user": ctx.author.id, "status": "pending"})
+        # Claiming the trade and reading it is one step, so a trade can only ever be accepted once
+        trade_request = await self.trades.find_one_and_update({"from_user": from_user_id, "to_user": ctx.author.id, "status": "pending"},
+                                                              {"$set": {"status": "accepted"}})
         if not trade_request:
             await ctx.send("No pending trade request found.")
             return
 
-        self.remove_from_inventory(trade_request["from_user"], trade_request["item"], trade_request["amount"])
-        self.add_to_inventory(ctx.author.id, trade_request["item"], trade_request["amount"])
-        self.trades.update_one({"_id": trade_request["_id"]}, {"$set": {"status": "accepted"}})
+        transaction = self.transaction()
+        transaction.debit(trade_request["from_user"], f"inventory.{trade_request['item']}", trade_request["amount"], drop_empty=True)
+        transaction.credit(ctx.author.id, f"inventory.{trade_request['item']}", trade_request["amount"])
+        if await transaction.commit() is None:
+            await self.trades.update_one({"_id": trade_request["_id"]}, {"$set": {"status": "failed"}})
+            await ctx.send("The trade could not be completed because the sender no longer has the items.")
+            return
+
         await ctx.send(f"Trade accepted. You have received {trade_request['amount']} x {trade_request['item']} from {self.bot.get_user(from_user_id).mention}.")
 
     @commands.command()
@@ -299,54 +389,67 @@ class Economy_Cog(commands.Cog):
         if item_type == "role":
             new_item["role_id"] = role_id
 
-        self.shop_items.append(new_item)
+        if self.catalog.get(name):
+            await ctx.send(f"An item named ``{name}`` already exists.")
+            return
+
+        self.catalog.add(new_item)
         self.save_shop_items()
         await ctx.send(f"Item ``{name}`` has been added to the shop.")
 
     @commands.command()
     @commands.has_permissions(administrator=True)
     async def remove_item(self, ctx, name: str):
-        item = next((item for item in self.shop_items if item["name"].lower() == name.lower()), None)
-        if not item:
-            await ctx.send("Item not found.")
+        if not self.catalog.remove(name):
+            await ctx.send(self.catalog.not_found_message(name))
             return
 
-        self.shop_items = [item for item in self.shop_items if item["name"].lower() != name.lower()]
         self.save_shop_items()
         await ctx.send(f"Item '{name}' removed from the shop.")
 
     @commands.command()
     @commands.has_permissions(administrator=True)
     async def modify_item(self, ctx, name: str, price: int = None, description: str = None):
-        item = next((item for item in self.shop_items if item["name"].lower() == name.lower()), None)
-        if not item:
-            await ctx.send("Item not found.")
+        if not self.catalog.modify(name, price, description):
+            await ctx.send(self.catalog.not_found_message(name))
             return
 
-        if price is not None:
-            item["price"] = price
-        if description is not None:
-            item["description"] = description
-
         self.save_shop_items()
         await ctx.send(f"Item '{name}' modified in the shop.")
 
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def reload_shop(self, ctx):
+        try:
+            reloaded = await self.shop_store.reload_if_changed()
+        except (OSError, ValueError) as e:
+            # ValueError covers a half-edited file that is not valid JSON yet
+            await ctx.send(f"Could not reload the shop: {e}")
+            return
+        if reloaded:
+            await ctx.send(f"Shop reloaded with {len(self.catalog)} items.")
+        else:
+            await ctx.send("The shop file has not changed or has unsaved edits pending.")
+
     @commands.command()
     async def invest(self, ctx, symbol: str, amount: int):
         """Invest in the stock market"""
-        result = self.stock_market.invest(ctx.author.id, symbol, amount)
+        result = await self.stock_market.invest(ctx.author.id, symbol, amount)
         await ctx.send(result)
 
     @commands.command()
     async def portfolio(self, ctx):
         # Check the stock portfolio
-        portfolio_value = self.stock_market.get_portfolio_value(ctx.author.id)
+        if not await self.wait_for_market():
+            await ctx.send(MARKET_UNAVAILABLE)
+            return
+        portfolio_value = await self.stock_market.get_portfolio_value(ctx.author.id)
         await ctx.send(f"{ctx.author.mention}, your portfolio is currently valued at ${portfolio_value:.2f}.")
 
     @commands.command()
     async def stock_performance(self, ctx):
         # Display stocks and their performances
-        stocks = self.stocks.find()
+        stocks = await self.stocks.find({})
         embed = discord.Embed(title="Stock Performance")
         for stock in stocks:
             name = stock.get("name", "Unknown Name")
@@ -357,18 +460,38 @@ class Economy_Cog(commands.Cog):
 
     @commands.command()
     async def sell_shares(self, ctx, symbol: str, shares: float):
-        user_data = self.get_user_data(ctx.author.id)
-        portfolio = user_data.get("portfolio", {})
-        if portfolio.get(symbol, 0) < shares:
-            await ctx.send("You don't have enough shares to sell.")
+        if shares <= 0:
+            await ctx.send("You must sell a positive number of shares.")
             return
 
-        stock_price = self.get_stock_price(symbol)
+        if not await self.wait_for_market():
+            await ctx.send(MARKET_UNAVAILABLE)
+            return
+        stock_price = await self.get_stock_price(symbol)
         if stock_price is None:
             await ctx.send("Invalid stock symbol.")
             return
 
         total_sale = shares * stock_price
-        self.users.update_one({"user_id": ctx.author.id}, {"$inc": {f"portfolio.{symbol}": -shares}})
-        self.update_user_balance(ctx.author.id, total_sale)
+        transaction = self.transaction()
+        transaction.debit(ctx.author.id, f"portfolio.{symbol}", shares)
+        transaction.credit(ctx.author.id, "balance", total_sale)
+        if await transaction.commit() is None:
+            await ctx.send("You don't have enough shares to sell.")
+            return
+
         await ctx.send(f"You have sold {shares} shares of {symbol} for ${total_sale:.2f}.")
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def dbstats(self, ctx):
+        # Per-operation Mongo latency and how long the event loop has been stalled
+        report = self.database.latency_report() or "No database operations recorded yet."
+        await ctx.send(f"```\n{report}\n{self.user_cache.stats_report()}\nstock tick: {self.stock_market.engine.tick_latency.summary()}\nevent loop lag: {self.loop_lag.histogram.summary()}\n```")
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def query_audit(self, ctx):
+        # explain() every query the cog issues and flag any that scan a whole collection
+        report = await self.database.call(audit_queries)
+        await ctx.send("```\n" + "\n".join(report) + "\n```")
@@ -1,5 +1,5 @@
-import random
-from utils import MeowEncoderDecoder, ConfigLoader
+from utils import MeowEncoderDecoder, ConfigService
+from autoresponder import AutoResponder
 from discord.ext import commands
 
 encoder_decoder = MeowEncoderDecoder()
@@ -8,12 +8,36 @@ class Events_Cog(commands.Cog, name="Events"):
     def __init__(self, bot, config_directory, *args, **kwargs):
         self.bot = bot
         self.config_directory = config_directory
-
-    #@commands.Cog.listener()
-
-
-
-
-
-
-
+        # The config is read once and hot-reloaded, the rule sets are recompiled whenever it changes
+        self.config_service = ConfigService(config_directory)
+        self.auto_responder = AutoResponder(self.config_service.config)
+        self.encode_responses(self.config_service.config)
+        self.config_service.listeners.extend((self.auto_responder.update, self.encode_responses))
+
+    def encode_responses(self, config):
+        # Responses are a small fixed set, so they are encoded once per config load
+        self.encoded_responses = {response: encoder_decoder.encode_message(response) for response in self.auto_responder.all_responses()}
+
+    async def cog_load(self):
+        self.config_service.start()
+
+    async def cog_unload(self):
+        self.config_service.stop()
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.author == self.bot.user or message.content.startswith('-'):
+            return
+
+        guild_id = message.guild.id if message.guild else None
+        response = self.auto_responder.respond(guild_id, message.channel.id, message.author.id, message.content)
+        if response:
+            print(response)
+
+            await message.channel.send(f'{message.author.mention} {self.encoded_responses[response]}')
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def filterstats(self, ctx):
+        rules = self.auto_responder.rules_for(ctx.guild.id if ctx.guild else None, ctx.channel.id)
+        await ctx.send(f"``{len(rules.word_filter.words)} filter words in this channel, {self.auto_responder.stats_report()}``")
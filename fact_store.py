@@ -0,0 +1,124 @@
+import asyncio
+import json
+import mmap
+import os
+import random
+import time
+from array import array
+
+class LineIndex:
+    # Read-only view of a line-delimited text file through mmap. Only the offset of each line is
+    # kept in memory, the text is read from the page cache when a line is asked for
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.starts = array('Q')
+        self.ends = array('Q')
+        position = 0
+        while position < size:
+            end = self.map.find(b'\n', position)
+            if end == -1:
+                end = size
+            # Blank lines are skipped so every index is a fact
+            if self.map[position:end].strip():
+                self.starts.append(position)
+                self.ends.append(end)
+            position = end + 1
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        return self.map[self.starts[index]:self.ends[index]].decode('utf-8').strip()
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+
+class JsonLineIndex(LineIndex):
+    # A LineIndex over a .jsonl file. Each line is a JSON string, or an object holding the entry
+    # under `key`, and is decoded when it is asked for. Lines that are not valid JSON give None
+    def __init__(self, path, key):
+        super().__init__(path)
+        self.key = key
+
+    def __getitem__(self, index):
+        try:
+            value = json.loads(super().__getitem__(index))
+        except ValueError:
+            return None
+        if isinstance(value, dict):
+            value = value.get(self.key)
+        return value if value is None or isinstance(value, str) else str(value)
+
+
+class ShuffleBag:
+    # Hands out every index once in random order before any repeats, then reshuffles.
+    # The first draw of a new round is never the last draw of the previous one
+    def __init__(self, size):
+        self.size = size
+        self.remaining = []
+        self.last = None
+
+    def draw(self):
+        if not self.remaining:
+            self.remaining = list(range(self.size))
+            random.shuffle(self.remaining)
+            if self.size > 1 and self.remaining[-1] == self.last:
+                self.remaining[0], self.remaining[-1] = self.remaining[-1], self.remaining[0]
+        self.last = self.remaining.pop()
+        return self.last
+
+
+class FactStore:
+    # Entries loaded once from either a JSON file holding {key: [...]} as an immutable tuple, or a
+    # .txt/.jsonl file with one entry per line through a LineIndex, for corpora too big to hold in
+    # memory. Lines of a .jsonl file are JSON strings or objects with the entry under `key`.
+    # The file is checked for changes at most every `check_interval` seconds
+    def __init__(self, path, key, check_interval=5):
+        self.path = path
+        self.key = key
+        self.check_interval = check_interval
+        self.checked_at = time.monotonic()
+        self.entries, self.mtime = self.read()
+        self.bag = ShuffleBag(len(self.entries))
+
+    def read(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if self.path.endswith('.jsonl'):
+            return JsonLineIndex(self.path, self.key), mtime
+        if self.path.endswith('.txt'):
+            return LineIndex(self.path), mtime
+        with open(self.path, 'r') as f:
+            return tuple(json.load(f)[self.key]), mtime
+
+    def __len__(self):
+        return len(self.entries)
+
+    async def reload_if_changed(self):
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval:
+            return False
+        self.checked_at = now
+        mtime = await asyncio.to_thread(lambda: os.stat(self.path).st_mtime_ns)
+        if mtime == self.mtime:
+            return False
+        old = self.entries
+        self.entries, self.mtime = await asyncio.to_thread(self.read)
+        self.bag = ShuffleBag(len(self.entries))
+        if isinstance(old, LineIndex):
+            old.close()
+        return True
+
+    async def draw(self):
+        # Returns a random entry, or None if the file has none
+        try:
+            await self.reload_if_changed()
+        except (OSError, ValueError, KeyError) as e:
+            print(f"An error occurred reloading {self.path}, keeping the loaded entries: {e}")
+        if not len(self.entries):
+            return None
+        return self.entries[self.bag.draw()]
@@ -1,69 +1,72 @@
 import discord
-import random
+import numpy as np
 from discord.ext import commands
 
+BOMB = -1
+EMOJIS = np.array(['💣', '⬜', '1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣'], dtype=object)
+NEIGHBOUR_DY = np.array([-1, -1, -1, 0, 0, 1, 1, 1])
+NEIGHBOUR_DX = np.array([-1, 0, 1, -1, 1, -1, 0, 1])
+
 class CatsweeperGame:
-    def __init__(self, size=5, bombs=5):
+    # The board is one flat int8 array (-1 for a bomb, otherwise the number of neighbouring bombs)
+    # and the mask one flat bool array, indexed by y * size + x. `board` and `mask` are 2D views
+    # of the same storage so board[y][x] and mask[y][x] still work
+    def __init__(self, size=5, bombs=5, rng=None):
         self.size = size
         self.bombs = bombs
-        self.board = [[0 for _ in range(size)] for _ in range(size)]
-        self.mask = [[False for _ in range(size)] for _ in range(size)]
+        self.rng = rng or np.random.default_rng()
+        self.cells = np.zeros(size * size, dtype=np.int8)
+        self.revealed = np.zeros(size * size, dtype=np.bool_)
+        self.board = self.cells.reshape(size, size)
+        self.mask = self.revealed.reshape(size, size)
+        # Safe cells still hidden, the game is won when this reaches 0
+        self.hidden_safe = size * size - bombs
         self.place_bombs()
         self.calculate_numbers()
 
     def place_bombs(self):
-        placed_bombs = 0
-        while placed_bombs < self.bombs:
-            x = random.randint(0, self.size - 1)
-            y = random.randint(0, self.size - 1)
-            if self.board[y][x] == 0:
-                self.board[y][x] = -1
-                placed_bombs += 1
+        # Sampling without replacement, so every bomb lands on its own cell on the first try
+        self.cells[self.rng.choice(self.size * self.size, self.bombs, replace=False)] = BOMB
 
     def calculate_numbers(self):
-        for y in range(self.size):
-            for x in range(self.size):
-                if self.board[y][x] == -1:
-                    continue
-                count = 0
-                for dy in [-1, 0, 1]:
-                    for dx in [-1, 0, 1]:
-                        if 0 <= x + dx < self.size and 0 <= y + dy < self.size:
-                            if self.board[y + dy][x + dx] == -1:
-                                count += 1
-                self.board[y][x] = count
+        # Neighbour counts as a 3x3 convolution of the bomb layout, summing shifted slices of a
+        # zero-padded copy
+        bombs = np.pad(self.board == BOMB, 1).astype(np.int8)
+        counts = np.zeros((self.size, self.size), dtype=np.int8)
+        for dy in range(3):
+            for dx in range(3):
+                if dy != 1 or dx != 1:
+                    counts += bombs[dy:dy + self.size, dx:dx + self.size]
+        self.board[...] = np.where(bombs[1:-1, 1:-1], BOMB, counts)
 
     def reveal(self, x, y):
-        if self.mask[y][x]:
+        # Flood fills from (x, y) one ring at a time: every step reveals all hidden neighbours of
+        # the current frontier of empty cells at once, and the empty ones among them form the next
+        # frontier. Neighbours of an empty cell are never bombs
+        index = y * self.size + x
+        if self.revealed[index]:
+            return
+        self.revealed[index] = True
+        if self.cells[index] == BOMB:
             return
-        self.mask[y][x] = True
-        if self.board[y][x] == 0:
-            for dy in [-1, 0, 1]:
-                for dx in [-1, 0, 1]:
-                    if 0 <= x + dx < self.size and 0 <= y + dy < self.size:
-                        self.reveal(x + dx, y + dy)
+        self.hidden_safe -= 1
+        frontier = np.array([index] if self.cells[index] == 0 else [], dtype=np.intp)
+        while frontier.size:
+            fy, fx = np.divmod(frontier, self.size)
+            ny = (fy[:, None] + NEIGHBOUR_DY).ravel()
+            nx = (fx[:, None] + NEIGHBOUR_DX).ravel()
+            inside = (ny >= 0) & (ny < self.size) & (nx >= 0) & (nx < self.size)
+            neighbours = np.unique(ny[inside] * self.size + nx[inside])
+            neighbours = neighbours[~self.revealed[neighbours]]
+            self.revealed[neighbours] = True
+            self.hidden_safe -= neighbours.size
+            frontier = neighbours[self.cells[neighbours] == 0]
 
     def check_win(self):
-        for y in range(self.size):
-            for x in range(self.size):
-                if self.board[y][x] != -1 and not self.mask[y][x]:
-                    return False
-        return True
+        return self.hidden_safe == 0
 
     def get_board_view(self):
-        emojis = {
-            -1: '💣',
-            0: '⬜',
-            1: '1️⃣',
-            2: '2️⃣',
-            3: '3️⃣',
-            4: '4️⃣',
-            5: '5️⃣',
-            6: '6️⃣',
-            7: '7️⃣',
-            8: '8️⃣',
-        }
-        return [[emojis[self.board[y][x]] if self.mask[y][x] else '⬛' for x in range(self.size)] for y in range(self.size)]
+        return np.where(self.mask, EMOJIS[self.board + 1], '⬛').tolist()
 
 class CatsweeperButton(discord.ui.Button):
     def __init__(self, x, y, game):
@@ -93,7 +96,7 @@ class CatsweeperButton(discord.ui.Button):
         for item in self.view.children:
             if isinstance(item, CatsweeperButton):
                 item.label = board_view[item.y][item.x]
-                item.disabled = self.game.mask[item.y][item.x]
+                item.disabled = bool(self.game.mask[item.y][item.x])
 
         await interaction.response.edit_message(view=self.view)
 
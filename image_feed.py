@@ -0,0 +1,72 @@
+import asyncio
+import re
+import aiohttp
+from urllib.parse import urljoin
+
+IMG_SRC = re.compile(r'''<img\b[^>]*?\bsrc\s*=\s*["']([^"']+)["']''', re.IGNORECASE)
+
+def extract_image_url(html, base_url=""):
+    # First <img src> on the page, resolved against the page URL
+    match = IMG_SRC.search(html)
+    return urljoin(base_url, match.group(1)) if match else None
+
+
+class ImageFeed:
+    # Fetches image URLs from an HTML page with one pooled aiohttp session and keeps a small buffer
+    # of them resolved in the background, so a command can answer without waiting on the site
+    def __init__(self, url, buffer_size=5, timeout=10, connections=4, retry_delay=30):
+        self.url = url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.connections = connections
+        self.retry_delay = retry_delay
+        self.buffer = asyncio.Queue(maxsize=buffer_size)
+        self.session = None
+        self.task = None
+        self.stats = {"served_from_buffer": 0, "fetched_on_demand": 0, "errors": 0, "no_image": 0}
+
+    def start(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=self.timeout, connector=aiohttp.TCPConnector(limit=self.connections))
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.prefetch())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def fetch(self):
+        async with self.session.get(self.url) as response:
+            response.raise_for_status()
+            html = await response.text()
+            return extract_image_url(html, str(response.url))
+
+    async def prefetch(self):
+        while True:
+            try:
+                image_url = await self.fetch()
+            except Exception as e:
+                # Anything but cancellation is retried later, so prefetching never stops for good
+                self.stats["errors"] += 1
+                print(f"An error occurred prefetching an image from {self.url}: {e}")
+                await asyncio.sleep(self.retry_delay)
+                continue
+            if image_url:
+                # Waits here while the buffer is full
+                await self.buffer.put(image_url)
+            else:
+                # The page had no image, asking again straight away would hammer the site
+                self.stats["no_image"] += 1
+                await asyncio.sleep(self.retry_delay)
+
+    async def get(self):
+        # Returns an image URL, or None if the page had no image. Raises aiohttp.ClientError or
+        # asyncio.TimeoutError if the buffer is empty and fetching fails
+        if not self.buffer.empty():
+            self.stats["served_from_buffer"] += 1
+            return self.buffer.get_nowait()
+        self.stats["fetched_on_demand"] += 1
+        return await self.fetch()
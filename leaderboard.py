@@ -0,0 +1,144 @@
+import bisect
+import math
+import time
+from collections import defaultdict
+
+METRICS = ("balance", "networth")
+
+class RankedSet:
+    # The highest scores seen so far, kept exact under updates. Every user outside the set is
+    # known to score at most `floor`, so a changed score can be placed without a database query.
+    # A floor of -inf means the set holds every user
+    def __init__(self, capacity, floor=float("-inf")):
+        self.capacity = capacity
+        self.floor = floor
+        self.keys = []
+        self.scores = {}
+
+    def insert(self, user_id, score):
+        bisect.insort(self.keys, (-score, user_id))
+        self.scores[user_id] = score
+        if len(self.keys) > self.capacity:
+            negative_score, evicted = self.keys.pop()
+            del self.scores[evicted]
+            self.floor = max(self.floor, -negative_score)
+
+    def remove(self, user_id):
+        score = self.scores.pop(user_id, None)
+        if score is not None:
+            del self.keys[bisect.bisect_left(self.keys, (-score, user_id))]
+
+    def update(self, user_id, score):
+        self.remove(user_id)
+        if score >= self.floor:
+            self.insert(user_id, score)
+
+    def covers(self, count):
+        return len(self.keys) >= count or self.floor == float("-inf")
+
+    def page(self, offset, limit):
+        return [(user_id, -negative_score) for negative_score, user_id in self.keys[offset:offset + limit]]
+
+
+class Board:
+    def __init__(self, ranked, epoch):
+        self.ranked = ranked
+        self.epoch = epoch
+        self.built_at = time.monotonic()
+
+
+class Leaderboard:
+    # Top-K rankings by balance or net worth (balance plus portfolio value), globally or per guild.
+    # Boards are built from Mongo once and then follow every change made through the user cache
+    def __init__(self, users, user_cache, quotes, capacity=100, per_page=10, guild_ttl=600):
+        self.users = users
+        self.user_cache = user_cache
+        self.quotes = quotes
+        self.capacity = capacity
+        self.per_page = per_page
+        self.guild_ttl = guild_ttl
+        self.boards = {}
+        self.guild_members = {}
+        self.user_guilds = defaultdict(set)
+        user_cache.listeners.append(self.on_user_changed)
+
+    def score(self, document, metric, prices):
+        score = document.get("balance", 0)
+        if metric == "networth":
+            score += sum(shares * prices.get(symbol, 0) for symbol, shares in document.get("portfolio", {}).items())
+        return score
+
+    def on_user_changed(self, user_id, document):
+        prices = self.quotes.snapshot.prices
+        for guild_id in (None, *self.user_guilds.get(user_id, ())):
+            for metric in METRICS:
+                board = self.boards.get((guild_id, metric))
+                if board is not None:
+                    board.ranked.update(user_id, self.score(document, metric, prices))
+
+    def is_stale(self, board, metric, guild_id):
+        # Net worth moves with every market tick, and guild membership drifts over time
+        if metric == "networth" and board.epoch != self.quotes.snapshot.epoch:
+            return True
+        return guild_id is not None and time.monotonic() - board.built_at > self.guild_ttl
+
+    async def page(self, page, metric="balance", guild=None):
+        # Returns ([(user_id, score), ...], total_pages)
+        # Pages past the top-K are rejected by the caller, they must not force a rebuild
+        guild_id = guild.id if guild else None
+        wanted = min(max(page, 1), self.max_pages)
+        board = self.boards.get((guild_id, metric))
+        if board is None or self.is_stale(board, metric, guild_id) or not board.ranked.covers(wanted * self.per_page):
+            board = await self.build(metric, guild)
+
+        ranked = board.ranked
+        pages = max(1, math.ceil(min(len(ranked.keys), self.capacity) / self.per_page))
+        if not 1 <= page <= pages:
+            return [], pages
+        return ranked.page((page - 1) * self.per_page, self.per_page), pages
+
+    @property
+    def max_pages(self):
+        return math.ceil(self.capacity / self.per_page)
+
+    async def build(self, metric, guild=None):
+        # Pending balance changes must be in Mongo before ranking from it
+        await self.user_cache.flush()
+        epoch = self.quotes.snapshot.epoch
+        prices = self.quotes.snapshot.prices
+
+        filter = {}
+        members = None
+        if guild is not None:
+            members = {member.id for member in guild.members if not member.bot}
+            filter = {"user_id": {"$in": list(members)}}
+
+        projection = {"user_id": 1, "balance": 1, "portfolio": 1}
+        documents = await self.users.find(filter, projection, sort=[("balance", -1)], limit=self.capacity)
+        # Users outside the top balances can only outrank them through their portfolio
+        floor = documents[-1].get("balance", 0) if len(documents) == self.capacity else float("-inf")
+        if metric == "networth":
+            holders = await self.users.find({**filter, "portfolio": {"$exists": True, "$ne": {}}}, projection)
+            documents = list({document["user_id"]: document for document in documents + holders}.values())
+
+        ranked = RankedSet(self.capacity, floor)
+        for document in documents:
+            ranked.insert(document["user_id"], self.score(document, metric, prices))
+        # Changes made while the query was running are still only in the cache
+        for user_id in list(self.user_cache.pending):
+            document = self.user_cache.documents.get(user_id)
+            if document is not None and (members is None or user_id in members):
+                ranked.update(user_id, self.score(document, metric, prices))
+
+        if guild is not None:
+            self.set_members(guild.id, members)
+        self.boards[(guild.id if guild else None, metric)] = board = Board(ranked, epoch)
+        return board
+
+    def set_members(self, guild_id, members):
+        old = self.guild_members.get(guild_id, set())
+        for user_id in old - members:
+            self.user_guilds[user_id].discard(guild_id)
+        for user_id in members - old:
+            self.user_guilds[user_id].add(guild_id)
+        self.guild_members[guild_id] = members
@@ -1,6 +1,4 @@
 import discord
-import random
-from utils import ConfigLoader, MeowEncoderDecoder
 from discord.ext import commands
 from command_cog import Commands_Cog, Music_Cog
 from event_cog import Events_Cog
@@ -16,30 +14,25 @@ intents.members = True
 client = commands.Bot(command_prefix='-', intents=intents)
 
 
-encoder_decoder = MeowEncoderDecoder()
 config_directory = 'config/config.json'
 facts_directory = 'config/facts.json'
-config_loader = ConfigLoader(config_directory)
-config = config_loader.load_config()
 
 @client.event
 async def on_message(message):
     if message.author == client.user:
         return
 
-    config = ConfigLoader(config_directory).load_config()
-    msg = message.content.lower()
-
-    if any(word in msg for word in config['filter_words']) and not message.content.startswith('-'):
-        response = random.choice(config['responses'])
-        print(response)
-
-        await message.channel.send(f'{message.author.mention} {encoder_decoder.encode_message(response)}')
-
+    # Filter word auto-responses are handled by Events_Cog
     await client.process_commands(message)
 
 
 db = os.environ.get('MONGO_URI')
+mongo_pool_size = int(os.environ.get('MONGO_POOL_SIZE', 8))
+mongo_max_pool_size = int(os.environ.get('MONGO_MAX_POOL_SIZE', 50))
+# Size of the on-disk audio cache for frequently played tracks, 0 turns it off
+audio_cache_mb = int(os.environ.get('AUDIO_CACHE_MB', 0))
+# Saved playlists and queue checkpoints go here when MONGO_URI is not set
+playlist_db = os.environ.get('PLAYLIST_DB', 'playlists.db')
 
 stock_data = "shopdata/stocks.json"
 shop_file = "shopdata/shopdata.json"
@@ -47,9 +40,9 @@ shop_file = "shopdata/shopdata.json"
 async def load_extensions():
     await client.add_cog(Events_Cog(client, config_directory))
     await client.add_cog(Commands_Cog(client, config_directory, facts_directory))
-    await client.add_cog(Music_Cog(client))
+    await client.add_cog(Music_Cog(client, audio_cache_mb, db, playlist_db))
     await client.add_cog(Games_Cog(client))
-    await client.add_cog(Economy_Cog(client, db, shop_file, stock_data, 2000))
+    await client.add_cog(Economy_Cog(client, db, shop_file, stock_data, 2000, mongo_pool_size, mongo_max_pool_size))
 
 
 @client.event
@@ -0,0 +1,628 @@
+import asyncio
+import heapq
+import itertools
+import random
+import re
+import threading
+import time
+import discord
+import yt_dlp as youtube_dl
+from collections import Counter, OrderedDict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from utils import LatencyHistogram
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f'{minutes}:{seconds:02d}'
+
+
+class Track:
+    # What is queued: plain data only, no ctx or channel objects.
+    # `offset` is where playback starts, in seconds, when a checkpointed track is resumed
+    __slots__ = ("url", "title", "artist", "duration", "requester_id", "offset")
+
+    def __init__(self, url, title, artist, duration, requester_id=None, offset=0):
+        self.url = url
+        self.title = title
+        self.artist = artist
+        self.duration = duration
+        self.requester_id = requester_id
+        self.offset = offset
+
+
+YOUTUBE_ID = re.compile(r'^[\w-]{11}$')
+
+def video_key(url):
+    # The same YouTube video has many URL forms (watch?v=, youtu.be/, shorts/, extra params)
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower().removeprefix('www.').removeprefix('m.').removeprefix('music.')
+    candidate = None
+    if host == 'youtu.be':
+        candidate = parsed.path.strip('/')
+    elif host == 'youtube.com':
+        if parsed.path == '/watch':
+            candidate = parse_qs(parsed.query).get('v', [None])[0]
+        elif parsed.path.startswith(('/shorts/', '/embed/', '/live/')):
+            candidate = parsed.path.split('/')[2]
+    if candidate and YOUTUBE_ID.match(candidate):
+        return f'youtube:{candidate}'
+    return url.strip()
+
+def cache_key(url):
+    # A link with a list id is a playlist even when it also names a video (watch?v=X&list=Y is a
+    # mix or playlist starting at X), so it must not share video X's cache entry
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower().removeprefix('www.').removeprefix('m.').removeprefix('music.')
+    if host == 'youtube.com' and parsed.path in ('/watch', '/playlist'):
+        playlist_id = parse_qs(parsed.query).get('list', [None])[0]
+        if playlist_id:
+            return f'youtube-list:{playlist_id}'
+    return video_key(url)
+
+def stream_expiry(stream_url, default):
+    # Signed googlevideo URLs carry their expiry as a unix timestamp
+    expire = parse_qs(urlparse(stream_url).query).get('expire', [None])[0]
+    return float(expire) if expire and expire.isdigit() else default
+
+
+class Extractor:
+    # Runs yt-dlp on a small thread pool and caches what it returns. Metadata is kept for
+    # `ttl` seconds, the stream URL only until shortly before its signature expires
+    def __init__(self, ydl_opts, workers=4, ttl=6 * 60 * 60, max_entries=2000, expiry_margin=5 * 60):
+        self.ydl_opts = ydl_opts
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='yt-dlp')
+        self.local = threading.local()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.expiry_margin = expiry_margin
+        self.cache = OrderedDict()
+        self.inflight = {}
+        self.latency = LatencyHistogram()
+        self.stats = {"hits": 0, "misses": 0, "stream_refreshes": 0, "errors": 0}
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def extract_sync(self, url):
+        # One YoutubeDL per worker thread, reused across extractions
+        ydl = getattr(self.local, 'ydl', None)
+        if ydl is None:
+            ydl = self.local.ydl = youtube_dl.YoutubeDL(self.ydl_opts)
+        info = ydl.extract_info(url, download=False)
+        if info is None:
+            return None
+        now = time.time()
+        entries = None
+        if info.get('_type') == 'playlist':
+            # With extract_flat the entries are only ids and titles, each is resolved when it plays
+            entries = [(entry.get('url') or f"https://www.youtube.com/watch?v={entry['id']}",
+                        entry.get('title') or 'Unknown Title',
+                        entry.get('uploader') or entry.get('channel') or 'Unknown Artist',
+                        entry.get('duration') or 0)
+                       for entry in info.get('entries') or () if entry]
+        # Only what the player uses is kept, the full info dict is large
+        return {
+            'id': info.get('id'),
+            'title': info.get('title', 'Unknown Title'),
+            'uploader': info.get('uploader', 'Unknown Artist'),
+            'duration': info.get('duration') or 0,
+            'url': info.get('url'),
+            'entries': entries,
+            'cached_at': now,
+            'expires_at': stream_expiry(info.get('url') or '', now + self.ttl),
+        }
+
+    def lookup(self, key, need_stream):
+        info = self.cache.get(key)
+        if info is None:
+            return None
+        now = time.time()
+        if now - info['cached_at'] > self.ttl:
+            del self.cache[key]
+            return None
+        if need_stream and info['entries'] is not None:
+            # A playlist has no stream of its own
+            return None
+        if need_stream and (not info['url'] or info['expires_at'] - now < self.expiry_margin):
+            self.stats["stream_refreshes"] += 1
+            return None
+        self.cache.move_to_end(key)
+        return info
+
+    def store(self, key, info):
+        self.cache[key] = info
+        self.cache.move_to_end(key)
+        if info['id'] and info['entries'] is None:
+            self.cache[f"youtube:{info['id']}"] = info
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+    async def extract(self, url, need_stream=True):
+        # Returns the cached info dict, or None if yt-dlp could not extract the URL. Playlists have
+        # their (url, title, uploader, duration) tuples in 'entries', which is None for videos.
+        # Concurrent requests for the same video share one extraction
+        key = cache_key(url)
+        info = self.lookup(key, need_stream)
+        if info is not None:
+            self.stats["hits"] += 1
+            return info
+        self.stats["misses"] += 1
+
+        future = self.inflight.get(key)
+        if future is None:
+            future = self.inflight[key] = asyncio.get_running_loop().create_task(self.run_extraction(key, url))
+        return await asyncio.shield(future)
+
+    async def run_extraction(self, key, url):
+        start = time.perf_counter()
+        try:
+            info = await asyncio.get_running_loop().run_in_executor(self.executor, self.extract_sync, url)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"An error occurred extracting {url}: {e}")
+            return None
+        finally:
+            self.latency.record(time.perf_counter() - start)
+            del self.inflight[key]
+        if info is None:
+            self.stats["errors"] += 1
+            return None
+        self.store(key, info)
+        return info
+
+    def stats_report(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        hit_rate = self.stats["hits"] / lookups if lookups else 0
+        return (f"hits={self.stats['hits']} misses={self.stats['misses']} hit rate={hit_rate:.0%} "
+                f"stream refreshes={self.stats['stream_refreshes']} errors={self.stats['errors']} cached={len(self.cache)}\n"
+                f"extraction latency: {self.latency.summary()}")
+
+
+class Playlist:
+    # Tracks in play order under stable entry ids. The OrderedDict is a linked list with an id map,
+    # so appending, popping the head and removing by id are O(1) and listing a page copies nothing
+    def __init__(self):
+        self.tracks = OrderedDict()
+        self.next_id = 1
+        self.nonempty = asyncio.Event()
+        # Bumped on every change, so a checkpoint can tell whether anything moved
+        self.version = 0
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __iter__(self):
+        return iter(self.tracks.values())
+
+    def append(self, track):
+        entry_id = self.next_id
+        self.next_id += 1
+        self.tracks[entry_id] = track
+        self.nonempty.set()
+        self.version += 1
+        return entry_id
+
+    def extend(self, tracks):
+        return [self.append(track) for track in tracks]
+
+    def peek(self):
+        return next(iter(self.tracks.values()), None)
+
+    def popleft(self):
+        # Returns the next track, or None if the playlist is empty
+        if not self.tracks:
+            return None
+        track = self.tracks.popitem(last=False)[1]
+        self.version += 1
+        if not self.tracks:
+            self.nonempty.clear()
+        return track
+
+    async def wait_next(self):
+        while not self.tracks:
+            await self.nonempty.wait()
+        return self.popleft()
+
+    def entry_id_at(self, index):
+        if not 0 <= index < len(self.tracks):
+            return None
+        return next(islice(self.tracks, index, None))
+
+    def remove(self, entry_id):
+        track = self.tracks.pop(entry_id, None)
+        self.version += 1
+        if not self.tracks:
+            self.nonempty.clear()
+        return track
+
+    def remove_at(self, index):
+        entry_id = self.entry_id_at(index)
+        return None if entry_id is None else self.remove(entry_id)
+
+    def move(self, index, new_index):
+        # Moves to the front or back are O(1), anywhere else rebuilds the order once
+        entry_id = self.entry_id_at(index)
+        if entry_id is None or not 0 <= new_index < len(self.tracks):
+            return None
+        self.version += 1
+        if new_index == 0:
+            self.tracks.move_to_end(entry_id, last=False)
+        elif new_index == len(self.tracks) - 1:
+            self.tracks.move_to_end(entry_id)
+        else:
+            order = list(self.tracks)
+            order.insert(new_index, order.pop(index))
+            self.reorder(order)
+        return self.tracks[entry_id]
+
+    def shuffle(self):
+        order = list(self.tracks)
+        random.shuffle(order)
+        self.reorder(order)
+
+    def reorder(self, order):
+        tracks = self.tracks
+        self.tracks = OrderedDict((entry_id, tracks[entry_id]) for entry_id in order)
+        self.version += 1
+
+    def clear(self):
+        self.tracks.clear()
+        self.nonempty.clear()
+        self.version += 1
+
+    def page(self, offset, limit):
+        # [(position, entry id, track)] with positions counted from 1
+        return [(position, entry_id, track) for position, (entry_id, track)
+                in enumerate(islice(self.tracks.items(), offset, offset + limit), offset + 1)]
+
+
+class TimerHeap:
+    # Cancellable timers for any number of keys driven by one task. Rescheduling or cancelling a key
+    # leaves its old heap entry behind, which is skipped when it reaches the top
+    def __init__(self):
+        self.heap = []
+        self.timers = {}
+        self.sequence = itertools.count()
+        self.changed = asyncio.Event()
+        self.running = set()
+        self.task = None
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def schedule(self, key, delay, callback):
+        # callback is a coroutine function, run as its own task so a slow one delays no other timer
+        due = time.monotonic() + delay
+        sequence = next(self.sequence)
+        self.timers[key] = (due, sequence, callback)
+        heapq.heappush(self.heap, (due, sequence, key))
+        if len(self.heap) > 2 * len(self.timers) + 64:
+            self.heap = [(due, sequence, key) for key, (due, sequence, callback) in self.timers.items()]
+            heapq.heapify(self.heap)
+        if self.heap[0][1] == sequence:
+            self.changed.set()
+
+    def cancel(self, key):
+        self.timers.pop(key, None)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def is_current(self, entry):
+        timer = self.timers.get(entry[2])
+        return timer is not None and timer[1] == entry[1]
+
+    async def run(self):
+        while True:
+            while self.heap and not self.is_current(self.heap[0]):
+                heapq.heappop(self.heap)
+            self.changed.clear()
+            if not self.heap:
+                await self.changed.wait()
+                continue
+            delay = self.heap[0][0] - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            entry = heapq.heappop(self.heap)
+            if self.is_current(entry):
+                callback = self.timers.pop(entry[2])[2]
+                task = asyncio.get_running_loop().create_task(callback())
+                self.running.add(task)
+                task.add_done_callback(self.finished)
+
+    def finished(self, task):
+        self.running.discard(task)
+        if not task.cancelled() and task.exception():
+            print(f"A timer callback failed: {task.exception()!r}")
+
+
+class GuildPlayer:
+    # Queue, now-playing state, voice client and playbar message of one guild.
+    # While a track plays the next one is resolved in the background, and again `refresh_lead`
+    # seconds before the end in case its stream URL expired meanwhile. With `prewarm` the FFmpeg
+    # source for the next track is also spawned at that point.
+    # The playbar is edited through the shared `timers` only when the bar itself moves, and no more
+    # often than `playbar_interval`, which backs off when Discord answers with 429
+    MIN_PLAYBAR_INTERVAL = 2
+    MAX_PLAYBAR_INTERVAL = 60
+
+    def __init__(self, guild_id, extractor, ffmpeg_opts, gap_latency=None, prewarm=False, refresh_lead=30,
+                 timers=None, playbar_stats=None, audio_cache=None):
+        self.guild_id = guild_id
+        self.extractor = extractor
+        self.ffmpeg_opts = ffmpeg_opts
+        self.gap_latency = gap_latency if gap_latency is not None else LatencyHistogram()
+        self.prewarm = prewarm
+        self.refresh_lead = refresh_lead
+        self.timers = timers
+        self.audio_cache = audio_cache
+        self.playbar_stats = playbar_stats if playbar_stats is not None else Counter()
+        self.playlist = Playlist()
+        self.lock = asyncio.Lock()
+        self.voice_channel = None
+        self.text_channel = None
+        self.voice_client = None
+        self.current = None
+        self.started_at = None
+        self.paused_at = None
+        self.finished_at = None
+        self.playbar_message = None
+        self.playbar_text = None
+        self.playbar_interval = self.MIN_PLAYBAR_INTERVAL
+        self.prefetch_task = None
+        # (track, stream url, FFmpeg source) spawned ahead of time
+        self.prepared = None
+        self.last_active = time.monotonic()
+
+    def is_playing(self):
+        return self.current is not None
+
+    def is_idle(self, now, timeout):
+        connected = self.voice_client is not None and self.voice_client.is_connected()
+        return not connected and self.current is None and not self.playlist and now - self.last_active > timeout
+
+    def peek(self):
+        return self.playlist.peek()
+
+    def enqueue(self, tracks):
+        self.last_active = time.monotonic()
+        was_empty = not self.playlist
+        entry_ids = self.playlist.extend(tracks)
+        if self.current is not None and was_empty:
+            self.schedule_prefetch()
+        return entry_ids
+
+    def stop(self):
+        # Drops the queue, so the track that is cut off does not start the next one
+        self.playlist.clear()
+        self.discard_prepared()
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+
+    def queue_changed(self):
+        # After a remove, move or shuffle the next track may be a different one
+        if self.current is not None:
+            self.schedule_prefetch()
+
+    def schedule_prefetch(self):
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+        self.prefetch_task = asyncio.get_running_loop().create_task(self.prefetch())
+
+    async def prefetch(self):
+        await self.extract_next()
+        current, started_at = self.current, self.started_at
+        if current is None or not current.duration:
+            return
+        await asyncio.sleep(max(0, current.duration - (time.monotonic() - started_at) - self.refresh_lead))
+        info = await self.extract_next()
+        track = self.peek()
+        if self.prewarm and info and info['url'] and track is not None:
+            if self.prepared and (self.prepared[0] is not track or self.prepared[1] != info['url']):
+                self.discard_prepared()
+            if self.prepared is None:
+                self.prepared = (track, info['url'], discord.FFmpegPCMAudio(info['url'], **self.seek_opts(self.ffmpeg_opts, track.offset)))
+
+    async def extract_next(self):
+        track = self.peek()
+        if track is None or (self.audio_cache and self.video_id(track) in self.audio_cache.files):
+            return None
+        return await self.extractor.extract(track.url)
+
+    def video_id(self, track):
+        key = video_key(track.url)
+        return key[len('youtube:'):] if key.startswith('youtube:') else None
+
+    @staticmethod
+    def seek_opts(ffmpeg_opts, offset):
+        if not offset:
+            return ffmpeg_opts
+        return {**ffmpeg_opts, 'before_options': f"{ffmpeg_opts.get('before_options', '')} -ss {offset:.1f}".strip()}
+
+    def checkpoint(self):
+        # What is needed to resume this guild's queue after a restart, or None if there is nothing
+        tracks = list(self.playlist)
+        if self.current is not None:
+            tracks.insert(0, self.current)
+            offset = self.elapsed()
+        else:
+            # A resumed queue that has not started again keeps the position it was saved at
+            offset = tracks[0].offset if tracks else 0
+        if not tracks or self.voice_channel is None or self.text_channel is None:
+            return None
+        return {"guild_id": self.guild_id, "voice_channel_id": self.voice_channel.id, "text_channel_id": self.text_channel.id,
+                "offset": round(offset, 1), "tracks": tracks}
+
+    def discard_prepared(self):
+        if self.prepared:
+            self.prepared[2].cleanup()
+            self.prepared = None
+
+    def take_source(self, track, stream_url):
+        # Use the pre-spawned FFmpeg source if it was made for this track and URL
+        prepared, self.prepared = self.prepared, None
+        if prepared and prepared[0] is track and prepared[1] == stream_url:
+            source = prepared[2]
+        else:
+            if prepared:
+                prepared[2].cleanup()
+            source = discord.FFmpegPCMAudio(stream_url, **self.seek_opts(self.ffmpeg_opts, track.offset))
+        return self.audio_cache.metered(source, 'streamed') if self.audio_cache else source
+
+    async def play_next(self):
+        async with self.lock:
+            while self.current is None and self.playlist:
+                track = self.playlist.popleft()
+                self.last_active = time.monotonic()
+
+                if self.voice_client is None or not self.voice_client.is_connected():
+                    self.voice_client = await self.voice_channel.connect()
+
+                # A cached file plays as is, otherwise the stream URL is usually a cache hit, prefetched
+                # while the previous track played or extracted by play()
+                video_id = self.video_id(track)
+                cached = self.audio_cache.get(video_id) if self.audio_cache and video_id else None
+                if cached:
+                    self.discard_prepared()
+                    source = self.audio_cache.source(cached, track.offset)
+                else:
+                    info = await self.extractor.extract(track.url)
+                    if info is None or not info['url']:
+                        await self.text_channel.send(f'Could not play ``{track.title}``, skipping it')
+                        continue
+                    source = self.take_source(track, info['url'])
+                    if self.audio_cache:
+                        self.audio_cache.record_play(video_id, info['url'])
+
+                self.current = track
+                # A resumed track starts part way through
+                self.started_at = time.monotonic() - track.offset
+                # The after callback runs on the audio thread
+                loop = asyncio.get_running_loop()
+                self.voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(self.song_finished(), loop))
+                if self.finished_at is not None:
+                    self.gap_latency.record(time.monotonic() - self.finished_at)
+                    self.finished_at = None
+                self.schedule_prefetch()
+
+                self.playbar_text = f'Now playing: ``{track.title}``\n By: ``{track.artist}``\n **{"—" * 30}** ``[0:00/{format_duration(track.duration)}]``'
+                self.playbar_message = await self.text_channel.send(self.playbar_text)
+                self.schedule_playbar()
+
+            if self.current is None:
+                # Nothing left to play, a source prepared for a removed track is not needed
+                self.discard_prepared()
+
+    async def song_finished(self):
+        self.finished_at = time.monotonic()
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+        self.current = None
+        self.started_at = None
+        self.paused_at = None
+        self.playbar_message = None
+        self.playbar_text = None
+        if self.timers is not None:
+            self.timers.cancel(("playbar", self.guild_id))
+        self.last_active = time.monotonic()
+        await self.play_next()
+        if self.current is None:
+            # The queue ran dry, so this was not a gap between tracks
+            self.finished_at = None
+
+    def render_playbar(self, elapsed):
+        track = self.current
+        bar_length = 30
+        progress = int(bar_length * (elapsed / track.duration))
+        playbar = f'{"=" * progress}{"-" * (bar_length - progress)}'
+        return f'Now playing: ``{track.title}``\n``{track.artist}``\n**{playbar}** ``[{format_duration(elapsed)}/{format_duration(track.duration)}]``'
+
+    def pause(self):
+        if self.current is not None and self.paused_at is None:
+            self.paused_at = time.monotonic()
+
+    def resume(self):
+        if self.paused_at is not None:
+            # The playbar counts time played, not time since the track started
+            self.started_at += time.monotonic() - self.paused_at
+            self.paused_at = None
+            self.schedule_playbar()
+
+    def elapsed(self):
+        return (self.paused_at or time.monotonic()) - self.started_at
+
+    def schedule_playbar(self):
+        # The next edit is due when the 30-character bar gains a character
+        if self.timers is None or self.current is None or not self.current.duration or self.paused_at is not None:
+            return
+        step = self.current.duration / 30
+        elapsed = self.elapsed()
+        delay = max((int(elapsed / step) + 1) * step - elapsed, self.playbar_interval)
+        if elapsed + delay <= self.current.duration:
+            self.timers.schedule(("playbar", self.guild_id), delay, self.update_playbar)
+
+    async def update_playbar(self):
+        if not self.playbar_message or self.current is None or self.paused_at is not None:
+            return
+        text = self.render_playbar(min(self.elapsed(), self.current.duration))
+        if text == self.playbar_text:
+            self.playbar_stats["skipped"] += 1
+        else:
+            try:
+                await self.playbar_message.edit(content=text)
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    self.playbar_stats["failed"] += 1
+                    print(f"Could not update the playbar in guild {self.guild_id}: {e}")
+                    return
+                self.playbar_stats["rate_limited"] += 1
+                self.playbar_interval = min(self.playbar_interval * 2, self.MAX_PLAYBAR_INTERVAL)
+            else:
+                self.playbar_stats["sent"] += 1
+                self.playbar_text = text
+                self.playbar_interval = max(self.playbar_interval * 0.75, self.MIN_PLAYBAR_INTERVAL)
+        self.schedule_playbar()
+
+
+class PlayerRegistry:
+    # One GuildPlayer per guild, created on first use and dropped once it has been disconnected
+    # and idle for `idle_timeout` seconds
+    def __init__(self, factory, idle_timeout=300):
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self.players = {}
+
+    def __len__(self):
+        return len(self.players)
+
+    def get(self, guild_id):
+        player = self.players.get(guild_id)
+        if player is None:
+            player = self.players[guild_id] = self.factory(guild_id)
+        return player
+
+    def find(self, guild_id):
+        return self.players.get(guild_id)
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for guild_id in [guild_id for guild_id, player in self.players.items() if player.is_idle(now, self.idle_timeout)]:
+            del self.players[guild_id]
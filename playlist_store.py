@@ -0,0 +1,110 @@
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import UpdateOne, DeleteOne
+from music import Track, video_key
+
+# Tracks are stored as [key, title, artist, duration] where the key is "youtube:<id>" for YouTube
+# videos and the URL otherwise. Nothing is extracted until a track is about to play
+
+def encode_track(track):
+    return [video_key(track.url), track.title, track.artist, track.duration]
+
+def decode_track(entry, requester_id=None):
+    key, title, artist, duration = entry
+    url = f"https://www.youtube.com/watch?v={key[len('youtube:'):]}" if key.startswith('youtube:') else key
+    return Track(url, title, artist, duration, requester_id)
+
+
+class MongoPlaylistStore:
+    # Playlists keyed by (guild, owner, name) and one queue checkpoint per guild
+    def __init__(self, database):
+        self.database = database
+        self.playlists = database.collection("playlists")
+        self.queues = database.collection("queues")
+
+    async def save_playlist(self, guild_id, owner_id, name, tracks):
+        await self.playlists.update_one({"guild_id": guild_id, "owner_id": owner_id, "name": name},
+                                        {"$set": {"tracks": tracks, "count": len(tracks), "updated_at": time.time()}}, upsert=True)
+
+    async def load_playlist(self, guild_id, owner_id, name):
+        document = await self.playlists.find_one({"guild_id": guild_id, "owner_id": owner_id, "name": name}, {"tracks": 1})
+        return document["tracks"] if document else None
+
+    async def list_playlists(self, guild_id, owner_id):
+        documents = await self.playlists.find({"guild_id": guild_id, "owner_id": owner_id}, {"name": 1, "count": 1}, sort=[("name", 1)])
+        return [(document["name"], document.get("count", 0)) for document in documents]
+
+    async def delete_playlist(self, guild_id, owner_id, name):
+        result = await self.playlists.delete_one({"guild_id": guild_id, "owner_id": owner_id, "name": name})
+        return result.deleted_count > 0
+
+    async def save_queues(self, states, removed):
+        requests = [UpdateOne({"guild_id": state["guild_id"]}, {"$set": state}, upsert=True) for state in states]
+        requests += [DeleteOne({"guild_id": guild_id}) for guild_id in removed]
+        if requests:
+            await self.queues.bulk_write(requests, ordered=False)
+
+    async def load_queues(self):
+        return await self.queues.find({}, {"_id": 0})
+
+    def close(self):
+        self.database.close()
+
+
+class SQLitePlaylistStore:
+    # Same interface backed by a local SQLite file, for running without Mongo. One worker thread
+    # owns the connection
+    def __init__(self, path):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS playlists (guild_id INTEGER, owner_id INTEGER, name TEXT, "
+                                    "tracks TEXT, updated_at REAL, PRIMARY KEY (guild_id, owner_id, name))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS queues (guild_id INTEGER PRIMARY KEY, state TEXT)")
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def execute(self, sql, parameters=()):
+        with self.connection:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    async def save_playlist(self, guild_id, owner_id, name, tracks):
+        await self.run(self.execute, "INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?)",
+                       (guild_id, owner_id, name, json.dumps(tracks), time.time()))
+
+    async def load_playlist(self, guild_id, owner_id, name):
+        rows = await self.run(self.execute, "SELECT tracks FROM playlists WHERE guild_id = ? AND owner_id = ? AND name = ?",
+                              (guild_id, owner_id, name))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def list_playlists(self, guild_id, owner_id):
+        rows = await self.run(self.execute, "SELECT name, json_array_length(tracks) FROM playlists "
+                                            "WHERE guild_id = ? AND owner_id = ? ORDER BY name", (guild_id, owner_id))
+        return [(name, count) for name, count in rows]
+
+    async def delete_playlist(self, guild_id, owner_id, name):
+        def delete():
+            with self.connection:
+                return self.connection.execute("DELETE FROM playlists WHERE guild_id = ? AND owner_id = ? AND name = ?",
+                                               (guild_id, owner_id, name)).rowcount > 0
+        return await self.run(delete)
+
+    async def save_queues(self, states, removed):
+        def save():
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO queues VALUES (?, ?)",
+                                            [(state["guild_id"], json.dumps(state)) for state in states])
+                self.connection.executemany("DELETE FROM queues WHERE guild_id = ?", [(guild_id,) for guild_id in removed])
+        await self.run(save)
+
+    async def load_queues(self):
+        rows = await self.run(self.execute, "SELECT state FROM queues")
+        return [json.loads(state) for state, in rows]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.connection.close()
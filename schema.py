@@ -0,0 +1,90 @@
+import os
+import sys
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+
+# (collection, keys, options). Default index names are kept so reruns are no-ops
+INDEXES = [
+    ("users", [("user_id", 1)], {"unique": True}),
+    ("users", [("balance", -1)], {}),
+    ("users", [("portfolio", 1)], {}),
+    ("stocks", [("symbol", 1)], {"unique": True}),
+    ("stock_history", [("symbol", 1), ("day", 1)], {"unique": True}),
+    ("trades", [("from_user", 1), ("to_user", 1), ("status", 1)], {}),
+    ("playlists", [("guild_id", 1), ("owner_id", 1), ("name", 1)], {"unique": True}),
+    ("queues", [("guild_id", 1)], {"unique": True}),
+]
+
+# Every query shape the economy cog issues: (collection, filter, sort, limit, full scan expected)
+QUERIES = [
+    ("users", {"user_id": 0}, None, 0, False),
+    ("users", {}, [("balance", -1)], 100, False),
+    ("users", {"user_id": {"$in": [0, 1]}}, [("balance", -1)], 100, False),
+    ("users", {"portfolio": {"$exists": True, "$ne": {}}}, None, 0, False),
+    ("stocks", {"symbol": ""}, None, 0, False),
+    ("stocks", {}, None, 0, True),
+    ("stock_history", {"symbol": "", "day": ""}, None, 0, False),
+    ("trades", {"from_user": 0, "to_user": 0, "status": "pending"}, None, 0, False),
+    ("playlists", {"guild_id": 0, "owner_id": 0, "name": ""}, None, 0, False),
+    ("playlists", {"guild_id": 0, "owner_id": 0}, [("name", 1)], 0, False),
+    ("queues", {}, None, 0, True),
+]
+
+def ensure_indexes(db, pending_trade_ttl=24 * 60 * 60):
+    for collection, keys, options in INDEXES:
+        try:
+            db[collection].create_index(keys, **options)
+        except OperationFailure as e:
+            # Usually duplicate user documents left over from before the unique index existed
+            print(f"Could not create index {keys} on {collection}: {e}")
+
+    # Pending trades expire on their own, accepted and failed ones are kept
+    ttl_options = {"expireAfterSeconds": pending_trade_ttl, "partialFilterExpression": {"status": "pending"}}
+    try:
+        db["trades"].create_index([("created_at", 1)], **ttl_options)
+    except OperationFailure:
+        # The TTL changed since the index was created, which only collMod can update
+        try:
+            db.command({"collMod": "trades", "index": {"keyPattern": {"created_at": 1}, "expireAfterSeconds": pending_trade_ttl}})
+        except OperationFailure as e:
+            print(f"Could not update the pending trade TTL: {e}")
+
+def find_stages(plan, stage):
+    if isinstance(plan, dict):
+        if plan.get("stage") == stage:
+            return True
+        return any(find_stages(value, stage) for value in plan.values())
+    if isinstance(plan, list):
+        return any(find_stages(value, stage) for value in plan)
+    return False
+
+def audit_queries(db):
+    # Runs explain() on each query shape and reports whether it scans the whole collection
+    report = []
+    for collection, filter, sort, limit, full_scan_expected in QUERIES:
+        cursor = db[collection].find(filter)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        collscan = find_stages(plan, "COLLSCAN")
+        if collscan and not full_scan_expected:
+            status = "COLLSCAN"
+        elif collscan:
+            status = "full scan (expected)"
+        else:
+            status = "index"
+        report.append(f"{status}: {collection} {filter}" + (f" sort={sort}" if sort else ""))
+    return report
+
+
+if __name__ == "__main__":
+    # python schema.py         creates the indexes
+    # python schema.py audit   also reports the query plan of every query
+    db = MongoClient(os.environ.get('MONGO_URI'))["users"]
+    ensure_indexes(db)
+    if "audit" in sys.argv[1:]:
+        report = audit_queries(db)
+        print("\n".join(report))
+        sys.exit(1 if any(line.startswith("COLLSCAN") for line in report) else 0)
@@ -0,0 +1,216 @@
+import asyncio
+import bisect
+import difflib
+import json
+import os
+import tempfile
+import discord
+from collections import defaultdict
+
+class ShopCatalog:
+    # Shop items with a case-folded name index, a type index and cached page embeds.
+    # Item order is the order of shopdata.json, which is also the page order
+    def __init__(self, items, items_per_page=15):
+        self.items = list(items)
+        self.items_per_page = items_per_page
+        self.page_embeds = {}
+        self.reindex()
+
+    def to_json(self):
+        return {"items": self.items}
+
+    def replace(self, items):
+        self.items = list(items)
+        self.reindex()
+
+    def reindex(self):
+        self.by_name = {item["name"].casefold(): item for item in self.items}
+        self.by_type = defaultdict(list)
+        for item in self.items:
+            self.by_type[item.get("type")].append(item)
+        self.sorted_names = sorted(self.by_name)
+        self.page_embeds.clear()
+        self.cached_page_count = self.page_count
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, name):
+        return self.by_name.get(name.casefold())
+
+    def of_type(self, item_type):
+        return self.by_type.get(item_type, [])
+
+    def suggest(self, name, limit=3):
+        # Names starting with what was typed come first, then close spellings
+        key = name.casefold()
+        start = bisect.bisect_left(self.sorted_names, key)
+        suggestions = []
+        for candidate in self.sorted_names[start:start + limit]:
+            if not candidate.startswith(key):
+                break
+            suggestions.append(candidate)
+        for candidate in difflib.get_close_matches(key, self.sorted_names, n=limit, cutoff=0.7):
+            if candidate not in suggestions:
+                suggestions.append(candidate)
+        return [self.by_name[candidate]["name"] for candidate in suggestions[:limit]]
+
+    def not_found_message(self, name):
+        suggestions = self.suggest(name)
+        if suggestions:
+            return "Item not found. Did you mean " + ", ".join(f"``{suggestion}``" for suggestion in suggestions) + "?"
+        return "Item not found."
+
+    def add(self, item):
+        self.items.append(item)
+        key = item["name"].casefold()
+        self.by_name[key] = item
+        self.by_type[item.get("type")].append(item)
+        bisect.insort(self.sorted_names, key)
+        self.invalidate_pages(len(self.items) - 1)
+
+    def remove(self, name):
+        item = self.get(name)
+        if item is None:
+            return None
+        index = next(index for index, candidate in enumerate(self.items) if candidate is item)
+        del self.items[index]
+        key = item["name"].casefold()
+        del self.by_name[key]
+        del self.sorted_names[bisect.bisect_left(self.sorted_names, key)]
+        self.by_type[item.get("type")].remove(item)
+        # Every item after the removed one moves up, so its page and all later pages change
+        self.invalidate_pages(index)
+        return item
+
+    def modify(self, name, price=None, description=None):
+        item = self.get(name)
+        if item is None:
+            return None
+        if price is not None:
+            item["price"] = price
+        if description is not None:
+            item["description"] = description
+        index = next(index for index, candidate in enumerate(self.items) if candidate is item)
+        page = index // self.items_per_page + 1
+        self.page_embeds.pop(page, None)
+        return item
+
+    def invalidate_pages(self, index):
+        # Every header shows the page count, so a new count invalidates all pages
+        if self.page_count != self.cached_page_count:
+            self.page_embeds.clear()
+            self.cached_page_count = self.page_count
+            return
+        first_page = index // self.items_per_page + 1
+        for page in [page for page in self.page_embeds if page >= first_page]:
+            del self.page_embeds[page]
+
+    @property
+    def page_count(self):
+        return max(1, (len(self.items) - 1) // self.items_per_page + 1)
+
+    def page_embed(self, page):
+        embed = self.page_embeds.get(page)
+        if embed is None:
+            start = (page - 1) * self.items_per_page
+            end = start + self.items_per_page
+            embed = discord.Embed(title="Shop", description=f"Page {page}/{self.page_count}")
+            for item in self.items[start:end]:
+                embed.add_field(name=item.get("name", "Unknown"), value=f"Price: ${item.get('price', 'Unknown')}, Type: {item.get('type', 'Unknown')}\nDescription: {item.get('description', 'No description')}", inline=False)
+            self.page_embeds[page] = embed
+        return embed
+
+
+def write_atomic(path, data):
+    # Write next to the target and rename over it, so a crash leaves either the old or the new file
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.shopdata-', suffix='.tmp', delete=False) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(path):
+        # Temporary files are private by default, keep the catalog's original permissions
+        os.chmod(f.name, os.stat(path).st_mode & 0o777)
+    os.replace(f.name, path)
+    return os.stat(path).st_mtime_ns
+
+def read_catalog(path):
+    mtime = os.stat(path).st_mtime_ns
+    with open(path, 'r') as f:
+        return json.load(f)["items"], mtime
+
+
+class CatalogStore:
+    # Persists a ShopCatalog as atomic snapshots written off the event loop. A burst of edits
+    # within `debounce` seconds of the first one is saved with a single write. Every edit bumps
+    # `version`, and the catalog is dirty until a snapshot of the latest version is on disk
+    def __init__(self, path, debounce=2.0):
+        self.path = path
+        self.debounce = debounce
+        items, self.mtime = read_catalog(path)
+        self.catalog = ShopCatalog(items)
+        self.version = 0
+        self.saved_version = 0
+        self.save_task = None
+        self.flush_requested = asyncio.Event()
+        self.lock = asyncio.Lock()
+
+    @property
+    def dirty(self):
+        return self.saved_version != self.version
+
+    def schedule_save(self):
+        self.version += 1
+        if self.save_task is None or self.save_task.done():
+            self.save_task = asyncio.get_running_loop().create_task(self.save_later())
+
+    async def save_later(self):
+        # Edits made while a snapshot is being written are picked up by the next pass
+        while self.dirty:
+            try:
+                await asyncio.wait_for(self.flush_requested.wait(), self.debounce)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.save()
+            except OSError as e:
+                print(f"An error occurred saving {self.path}: {e}")
+                return
+
+    async def save(self):
+        async with self.lock:
+            # Serialised on the loop so the snapshot is consistent, written in a thread
+            version = self.version
+            data = json.dumps(self.catalog.to_json(), indent=4)
+            self.mtime = await asyncio.to_thread(write_atomic, self.path, data)
+            self.saved_version = max(self.saved_version, version)
+
+    async def flush(self):
+        # Writes pending edits now instead of after the debounce
+        if self.save_task and not self.save_task.done():
+            self.flush_requested.set()
+            try:
+                await self.save_task
+            finally:
+                self.flush_requested.clear()
+        if self.dirty:
+            await self.save()
+
+    async def reload_if_changed(self):
+        # Picks up edits made to the file outside the bot. Returns True if the catalog was replaced
+        mtime = await asyncio.to_thread(lambda: os.stat(self.path).st_mtime_ns)
+        if mtime == self.mtime:
+            return False
+        if self.dirty:
+            print("shopdata.json changed on disk while shop edits are pending, keeping the bot's version")
+            return False
+        version = self.version
+        items, mtime = await asyncio.to_thread(read_catalog, self.path)
+        # An edit made while the file was being read wins over the file, and its save sets `mtime`
+        if self.version != version:
+            print("shopdata.json changed on disk while shop edits are pending, keeping the bot's version")
+            return False
+        self.catalog.replace(items)
+        self.mtime = mtime
+        return True
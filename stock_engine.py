@@ -0,0 +1,128 @@
+import time
+import numpy as np
+from datetime import datetime
+from types import MappingProxyType
+from pymongo import UpdateOne
+from utils import LatencyHistogram
+
+class PriceHistory:
+    # Ring buffer of the most recent ticks, one row per tick and one column per symbol
+    def __init__(self, capacity=96 * 7):
+        self.capacity = capacity
+        self.symbols = ()
+        self.columns = {}
+        self.prices = np.zeros((capacity, 0), dtype=np.float32)
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.head = 0
+        self.count = 0
+
+    def resize(self, symbols):
+        # Keep the history of symbols that survive a change to the symbol list
+        prices = np.full((self.capacity, len(symbols)), np.nan, dtype=np.float32)
+        for column, symbol in enumerate(symbols):
+            old = self.columns.get(symbol)
+            if old is not None:
+                prices[:, column] = self.prices[:, old]
+        self.prices = prices
+        self.symbols = symbols
+        self.columns = {symbol: column for column, symbol in enumerate(symbols)}
+
+    def append(self, timestamp, symbols, prices):
+        if symbols != self.symbols:
+            self.resize(symbols)
+        self.prices[self.head] = prices
+        self.times[self.head] = timestamp
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def series(self, symbol, limit=None):
+        # Returns (timestamps, prices) for a symbol, oldest first
+        column = self.columns.get(symbol)
+        if column is None:
+            return np.empty(0), np.empty(0, dtype=np.float32)
+        order = (np.arange(self.head - self.count, self.head)) % self.capacity
+        if limit:
+            order = order[-limit:]
+        return self.times[order], self.prices[order, column]
+
+
+class QuoteSnapshot:
+    __slots__ = ("epoch", "prices")
+
+    def __init__(self, epoch, prices):
+        self.epoch = epoch
+        self.prices = MappingProxyType(prices)
+
+
+class QuoteTable:
+    # Process-local stock prices. Every update swaps in a whole new snapshot, so anything that
+    # holds on to one snapshot values all its symbols against the same tick
+    def __init__(self):
+        self.snapshot = QuoteSnapshot(0, {})
+
+    def publish(self, prices):
+        self.snapshot = QuoteSnapshot(self.snapshot.epoch + 1, dict(prices))
+
+    def update(self, symbol, price):
+        self.publish({**self.snapshot.prices, symbol: price})
+
+    def get(self, symbol):
+        return self.snapshot.prices.get(symbol)
+
+
+class StockEngine:
+    # Advances every stock in one vectorized step.
+    # Drift and volatility are per day and can be set per stock with "drift" and "volatility" fields
+    def __init__(self, stocks, history, quotes, model="gbm", interval_minutes=15, drift=0.0, volatility=0.2,
+                 history_capacity=96 * 7, seed=None):
+        self.stocks = stocks
+        self.history_collection = history
+        self.quotes = quotes
+        self.model = model
+        self.dt = interval_minutes / (60 * 24)
+        self.default_drift = drift
+        self.default_volatility = volatility
+        self.rng = np.random.default_rng(seed)
+        self.history = PriceHistory(history_capacity)
+        self.tick_latency = LatencyHistogram()
+
+    def step(self, prices, drift, volatility):
+        if self.model == "uniform":
+            change = self.rng.uniform(-0.05, 0.05, len(prices))
+            new_prices = prices * (1 + change)
+        else:
+            # Geometric Brownian motion, exact discretisation so prices stay positive
+            shocks = self.rng.standard_normal(len(prices))
+            new_prices = prices * np.exp((drift - 0.5 * volatility ** 2) * self.dt + volatility * np.sqrt(self.dt) * shocks)
+        return np.maximum(np.round(new_prices, 2), 0.01)
+
+    async def tick(self):
+        start = time.perf_counter()
+        documents = await self.stocks.find({}, {"symbol": 1, "price": 1, "drift": 1, "volatility": 1})
+        documents = [document for document in documents if document.get("price") is not None]
+        if not documents:
+            return
+
+        symbols = tuple(document["symbol"] for document in documents)
+        prices = np.fromiter((document["price"] for document in documents), dtype=np.float64, count=len(documents))
+        drift = np.fromiter((document.get("drift", self.default_drift) for document in documents), dtype=np.float64, count=len(documents))
+        volatility = np.fromiter((document.get("volatility", self.default_volatility) for document in documents), dtype=np.float64, count=len(documents))
+        new_prices = self.step(prices, drift, volatility).tolist()
+
+        now = datetime.utcnow()
+        await self.stocks.bulk_write([UpdateOne({"symbol": symbol}, {"$set": {"price": price}})
+                                      for symbol, price in zip(symbols, new_prices)], ordered=False)
+        quotes = dict(zip(symbols, new_prices))
+        self.quotes.publish(quotes)
+        self.history.append(now.timestamp(), symbols, new_prices)
+        await self.store_history(now, symbols, new_prices)
+        self.tick_latency.record(time.perf_counter() - start)
+        return quotes
+
+    async def store_history(self, now, symbols, prices):
+        # One bucket document per symbol per day keeps the collection small and reads contiguous
+        day = now.strftime("%Y-%m-%d")
+        await self.history_collection.bulk_write([
+            UpdateOne({"symbol": symbol, "day": day}, {"$push": {"ticks": {"t": now, "p": price}}, "$inc": {"count": 1}}, upsert=True)
+            for symbol, price in zip(symbols, prices)
+        ], ordered=False)
@@ -0,0 +1,481 @@
+import asyncio
+import time
+from collections import Counter, OrderedDict
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, ConfigurationError, OperationFailure
+from utils import LatencyHistogram
+
+def get_path(document, path, default=None):
+    for key in path.split("."):
+        if not isinstance(document, dict) or key not in document:
+            return default
+        document = document[key]
+    return document
+
+def set_path(document, path, value):
+    *parents, last = path.split(".")
+    for key in parents:
+        document = document.setdefault(key, {})
+    document[last] = value
+
+def unset_path(document, path):
+    *parents, last = path.split(".")
+    for key in parents:
+        document = document.get(key)
+        if not isinstance(document, dict):
+            return
+    document.pop(last, None)
+
+
+class GuardRejected(Exception):
+    # Raised inside a write when a guarded debit no longer matches the stored document
+    def __init__(self, user_id):
+        super().__init__(f"guard rejected the update for user {user_id}")
+        self.user_id = user_id
+
+
+def undo_update(update, before):
+    # The inverse of an applied update, from the document as it was before it
+    undo = {}
+    for field, delta in update.get("$inc", {}).items():
+        undo.setdefault("$inc", {})[field] = -delta
+    for field in list(update.get("$set", {})) + list(update.get("$unset", {})):
+        value = get_path(before, field)
+        if value is None:
+            undo.setdefault("$unset", {})[field] = ""
+        else:
+            undo.setdefault("$set", {})[field] = value
+    return undo
+
+def write_with_undo(collection, rows):
+    # All-or-nothing without server transactions: guarded rows go first, each returning its
+    # pre-image, and if one is rejected the ones already applied are reverted. Unguarded rows
+    # cannot be rejected, so they are written last
+    applied = []
+    for user_id, filter, update in sorted(rows, key=lambda row: len(row[1]) == 1):
+        if len(filter) == 1:
+            collection.update_one(filter, update)
+            continue
+        before = collection.find_one_and_update(filter, update, return_document=ReturnDocument.BEFORE)
+        if before is None:
+            for applied_id, applied_update, applied_before in reversed(applied):
+                collection.update_one({"user_id": applied_id}, undo_update(applied_update, applied_before))
+            raise GuardRejected(user_id)
+        applied.append((user_id, update, before))
+
+def write_in_transaction(collection, rows):
+    with collection.database.client.start_session() as session:
+        def callback(session):
+            for user_id, filter, update in rows:
+                if collection.update_one(filter, update, session=session).matched_count == 0:
+                    raise GuardRejected(user_id)
+        session.with_transaction(callback)
+
+
+class PendingWrite:
+    # Coalesced changes for one user. $inc deltas are summed, and once a field has been
+    # $set or $unset any later change is folded into a $set of its final value
+    def __init__(self):
+        self.inc = {}
+        self.set = {}
+        self.unset = set()
+        self.guards = set()
+        self.ops = 0
+
+    def add_inc(self, field, delta, value, guard=False):
+        if field in self.set or field in self.unset:
+            self.unset.discard(field)
+            self.set[field] = value
+        else:
+            self.inc[field] = self.inc.get(field, 0) + delta
+            if guard:
+                self.guards.add(field)
+        self.ops += 1
+
+    def add_set(self, field, value):
+        self.inc.pop(field, None)
+        self.unset.discard(field)
+        self.guards.discard(field)
+        self.set[field] = value
+        self.ops += 1
+
+    def add_unset(self, field):
+        self.inc.pop(field, None)
+        self.set.pop(field, None)
+        self.guards.discard(field)
+        self.unset.add(field)
+        self.ops += 1
+
+    def merge(self, later):
+        # Replays a newer batch on top of this one, used when a failed flush is re-queued
+        for field, value in later.set.items():
+            self.add_set(field, value)
+        for field in later.unset:
+            self.add_unset(field)
+        for field, delta in later.inc.items():
+            if field in self.set:
+                self.set[field] = self.set[field] + delta
+            else:
+                self.inc[field] = self.inc.get(field, 0) + delta
+        self.guards |= later.guards - self.set.keys()
+        self.ops += later.ops
+
+    def replay(self, document):
+        # Applies these changes to a document read from Mongo
+        for field, value in self.set.items():
+            set_path(document, field, value)
+        for field in self.unset:
+            unset_path(document, field)
+        for field, delta in self.inc.items():
+            set_path(document, field, get_path(document, field, 0) + delta)
+
+    def to_filter(self, user_id):
+        # A net debit on a guarded field only applies if the stored value still covers it
+        filter = {"user_id": user_id}
+        for field in self.guards:
+            delta = self.inc.get(field)
+            if delta is not None and delta < 0:
+                filter[field] = {"$gte": -delta}
+        return filter
+
+    def to_update(self):
+        update = {}
+        if self.inc:
+            update["$inc"] = dict(self.inc)
+        if self.set:
+            update["$set"] = dict(self.set)
+        if self.unset:
+            update["$unset"] = {field: "" for field in self.unset}
+        return update
+
+
+class UserCache:
+    # LRU cache of user documents in front of the users collection with write-behind flushing.
+    # Documents handed out are the cached objects themselves and must be treated as read-only.
+    def __init__(self, collection, defaults, max_size=10000, flush_interval_ms=500, flush_ops=100):
+        self.collection = collection
+        self.defaults = defaults
+        self.max_size = max_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_ops = flush_ops
+        self.documents = OrderedDict()
+        self.pending = {}
+        self.pending_ops = 0
+        self.loading = {}
+        self.flushing = set()
+        self.pinned = Counter()
+        # User ids changed together by one guarded transaction since the last flush. Their rows
+        # are written all-or-nothing so a rejected debit cannot leave the matching credit applied
+        self.links = []
+        # Whether the deployment supports multi-document transactions, None until first tried
+        self.transactions = None
+        # Called with (user_id, document) after every change, e.g. to keep rankings current
+        self.listeners = []
+        self.stats = Counter()
+        self.flush_latency = LatencyHistogram()
+        self.flush_lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        # The loop is asked to stop rather than cancelled, since cancelling it part way through a
+        # flush would lose the batch it had taken out of `pending`
+        if self.task:
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+        await self.flush()
+
+    async def run(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"An error occurred flushing user data: {e}")
+
+    async def get(self, user_id):
+        document = self.documents.get(user_id)
+        if document is not None:
+            self.documents.move_to_end(user_id)
+            self.stats["hits"] += 1
+            return document
+
+        self.stats["misses"] += 1
+        # Concurrent misses for the same user share a single read
+        task = self.loading.get(user_id)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self.load(user_id))
+            self.loading[user_id] = task
+        document = await asyncio.shield(task)
+        # Another load may have evicted the document before this caller resumed. Callers change
+        # what they get back, so hand out the resident copy, putting this one back if there is none.
+        # An evicted document was clean, so it still matches Mongo
+        resident = self.documents.get(user_id)
+        if resident is None:
+            self.documents[user_id] = resident = document
+        return resident
+
+    async def load(self, user_id):
+        try:
+            document = await self.collection.find_one_and_update({"user_id": user_id}, {"$setOnInsert": dict(self.defaults)}, upsert=True)
+            self.documents[user_id] = document
+            self.evict()
+            return document
+        finally:
+            self.loading.pop(user_id, None)
+
+    def evict(self):
+        # Only clean documents can be dropped, dirty, in-flight or pinned ones stay resident
+        excess = len(self.documents) - self.max_size
+        if excess <= 0:
+            return
+        busy = self.pending.keys() | self.flushing | self.pinned.keys()
+        for user_id in [user_id for user_id in self.documents if user_id not in busy][:excess]:
+            del self.documents[user_id]
+            self.stats["evictions"] += 1
+
+    async def update(self, user_id, inc=None, set=None, unset=None):
+        document = await self.get(user_id)
+        self.apply(user_id, document, inc, set, unset)
+        return document
+
+    def apply(self, user_id, document, inc=None, set=None, unset=None, guard=False):
+        # Synchronous so the read-modify-write on the cached document can never interleave
+        pending = self.pending.get(user_id)
+        if pending is None:
+            pending = self.pending[user_id] = PendingWrite()
+        elif pending.ops:
+            self.stats["coalesced"] += 1
+
+        for field, value in (set or {}).items():
+            set_path(document, field, value)
+            pending.add_set(field, value)
+        for field in unset or ():
+            unset_path(document, field)
+            pending.add_unset(field)
+        for field, delta in (inc or {}).items():
+            value = get_path(document, field, 0) + delta
+            set_path(document, field, value)
+            pending.add_inc(field, delta, value, guard)
+
+        self.pending_ops += 1
+        if self.pending_ops >= self.flush_ops:
+            self.wakeup.set()
+        for listener in self.listeners:
+            listener(user_id, document)
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            links, self.links = self.links, []
+            self.pending_ops = 0
+            rows = {user_id: (user_id, write.to_filter(user_id), write.to_update()) for user_id, write in pending.items()}
+            # Rows without a guard cannot be rejected and go in one unordered bulk write. Guarded
+            # rows are written one group of linked users at a time, which reports exactly which
+            # groups were rejected
+            groups = []
+            plain = []
+            for group in self.linked_groups(list(pending), links):
+                if len(group) == 1 and len(rows[group[0]][1]) == 1:
+                    plain.append(group[0])
+                else:
+                    groups.append([rows[user_id] for user_id in group])
+
+            self.flushing.update(pending)
+            start = time.perf_counter()
+            try:
+                if plain:
+                    try:
+                        await self.collection.bulk_write([UpdateOne(rows[user_id][1], rows[user_id][2]) for user_id in plain], ordered=False)
+                    except BulkWriteError as e:
+                        # Only the failed updates are retried, the rest were applied
+                        self.requeue({plain[error["index"]]: pending[plain[error["index"]]] for error in e.details["writeErrors"]})
+                        raise
+                    except Exception:
+                        self.requeue({user_id: pending[user_id] for user_id in plain})
+                        raise
+                results = await self.collection.run("guarded_write", self.write_groups, self.collection.collection, groups) if groups else []
+            except Exception:
+                # Groups not written yet are retried with their links
+                for group in groups:
+                    self.requeue({user_id: pending[user_id] for user_id, filter, update in group})
+                    self.links.append([user_id for user_id, filter, update in group])
+                raise
+            finally:
+                self.flushing.clear()
+                self.flush_latency.record(time.perf_counter() - start)
+
+            error = None
+            rejected = []
+            for group, result in zip(groups, results):
+                user_ids = [user_id for user_id, filter, update in group]
+                if isinstance(result, GuardRejected):
+                    # Someone else changed the stored document, so nothing in the group was applied
+                    print(f"A guard rejected the update for user {result.user_id}, {len(user_ids)} linked user updates were not applied")
+                    self.stats["guard_failures"] += len(user_ids)
+                    rejected += user_ids
+                elif isinstance(result, Exception):
+                    self.requeue({user_id: pending[user_id] for user_id in user_ids})
+                    self.links.append(user_ids)
+                    error = result
+
+            if rejected:
+                await self.refresh(rejected)
+
+            self.stats["flushes"] += 1
+            self.stats["flushed_documents"] += len(rows)
+            self.evict()
+            if error is not None:
+                raise error
+
+    async def refresh(self, user_ids):
+        # The cached copies of rejected rows still hold the changes Mongo refused. Each is rebuilt in
+        # place from the stored document plus whatever was changed since the flush started, so
+        # callers holding the document see the same object
+        try:
+            stored = {document["user_id"]: document for document in await self.collection.find({"user_id": {"$in": user_ids}})}
+        except Exception as e:
+            print(f"An error occurred reloading rejected users, dropping the cached copies: {e}")
+            stored = {}
+        for user_id in user_ids:
+            document = self.documents.get(user_id)
+            if document is None:
+                continue
+            fresh = stored.get(user_id)
+            if fresh is None:
+                self.invalidate(user_id)
+                continue
+            pending = self.pending.get(user_id)
+            if pending is not None:
+                pending.replay(fresh)
+            document.clear()
+            document.update(fresh)
+            for listener in self.listeners:
+                listener(user_id, document)
+
+    def linked_groups(self, user_ids, links):
+        # Connected components of the users changed together, every other user is a group of one
+        parent = {user_id: user_id for user_id in user_ids}
+
+        def find(user_id):
+            while parent[user_id] != user_id:
+                parent[user_id] = parent[parent[user_id]]
+                user_id = parent[user_id]
+            return user_id
+
+        for link in links:
+            for user_id in link[1:]:
+                parent[find(user_id)] = find(link[0])
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(find(user_id), []).append(user_id)
+        return list(groups.values())
+
+    def write_groups(self, collection, groups):
+        # Runs in a worker thread. Returns, for each group, None if it was applied, or the
+        # GuardRejected or other exception that stopped it, in which case nothing was applied
+        results = []
+        for rows in groups:
+            try:
+                if len(rows) == 1:
+                    user_id, filter, update = rows[0]
+                    if collection.update_one(filter, update).matched_count == 0:
+                        raise GuardRejected(user_id)
+                elif self.transactions is not False:
+                    try:
+                        write_in_transaction(collection, rows)
+                        self.transactions = True
+                    except (NotImplementedError, ConfigurationError, OperationFailure) as e:
+                        # Standalone servers and mongomock have no transactions. 20 is IllegalOperation
+                        if self.transactions or (isinstance(e, OperationFailure) and e.code != 20):
+                            raise
+                        self.transactions = False
+                        write_with_undo(collection, rows)
+                else:
+                    write_with_undo(collection, rows)
+                results.append(None)
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def commit(self, transaction):
+        user_ids = list(dict.fromkeys(change[0] for change in transaction.changes))
+        # Participants are pinned so loading one cannot evict another
+        self.pinned.update(user_ids)
+        try:
+            documents = {user_id: await self.get(user_id) for user_id in user_ids}
+        finally:
+            self.pinned.subtract(user_ids)
+            self.pinned += Counter()
+
+        # From here on nothing awaits, so checking the guards and applying the changes is atomic
+        totals = {}
+        for user_id, field, delta, guarded, drop_empty in transaction.changes:
+            key = (user_id, field)
+            totals[key] = totals.get(key, get_path(documents[user_id], field, 0)) + delta
+            if guarded and totals[key] < 0:
+                self.stats["rejected_transactions"] += 1
+                return None
+
+        if len(user_ids) > 1 and any(change[3] for change in transaction.changes):
+            self.links.append(user_ids)
+        for user_id, field, delta, guarded, drop_empty in transaction.changes:
+            document = documents[user_id]
+            if drop_empty and get_path(document, field, 0) + delta <= 0:
+                self.apply(user_id, document, unset=[field])
+            else:
+                self.apply(user_id, document, inc={field: delta}, guard=guarded)
+        self.stats["transactions"] += 1
+        return documents
+
+    def requeue(self, failed):
+        for user_id, pending in failed.items():
+            later = self.pending.get(user_id)
+            if later is not None:
+                pending.merge(later)
+            self.pending[user_id] = pending
+            self.pending_ops += pending.ops
+
+    def invalidate(self, user_id):
+        if user_id not in self.pending and user_id not in self.pinned:
+            self.documents.pop(user_id, None)
+
+    def stats_report(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        hit_rate = self.stats["hits"] / lookups * 100 if lookups else 0
+        return (f"user cache: size={len(self.documents)} hit_rate={hit_rate:.1f}% coalesced={self.stats['coalesced']} "
+                f"evictions={self.stats['evictions']} flushes={self.stats['flushes']} flushed_documents={self.stats['flushed_documents']}\n"
+                f"transactions: committed={self.stats['transactions']} rejected={self.stats['rejected_transactions']} guard_failures={self.stats['guard_failures']}\n"
+                f"user cache flush: {self.flush_latency.summary()}")
+
+
+class Transaction:
+    # Guarded changes across one or more users, applied all-or-nothing through the cache and
+    # written all-or-nothing by the flush. commit() returns the post-change documents keyed by user id, or None if a debit would go negative
+    def __init__(self, cache):
+        self.cache = cache
+        self.changes = []
+
+    def debit(self, user_id, field, amount, drop_empty=False):
+        self.changes.append((user_id, field, -amount, True, drop_empty))
+        return self
+
+    def credit(self, user_id, field, amount):
+        self.changes.append((user_id, field, amount, False, False))
+        return self
+
+    async def commit(self):
+        return await self.cache.commit(self)
@@ -1,10 +1,19 @@
 import string
 import json
 import random
+import bisect
+import hashlib
+import os
+import re
+import time
+import asyncio
+from collections import OrderedDict
 
 class MeowEncoderDecoder:
     def __init__(self):
         self.encoding_map, self.decoding_map = self.create_mapping()
+        # Decoded letters carry their trailing space so decoding is a single join
+        self.decoding_table = {code: char + ' ' for code, char in self.decoding_map.items()}
 
     def create_mapping(self):
         alphabet = string.ascii_uppercase
@@ -20,26 +29,52 @@ class MeowEncoderDecoder:
         return encoding_map, decoding_map
 
     def encode_message(self, message):
-        encoded_message = []
-
-        for char in message.upper():
-            if char in self.encoding_map:
-                encoded_message.append(self.encoding_map[char])
-            else:
-                encoded_message.append(char) # Leave non-alphabetic characters as they are
-
-        return ' '.join(encoded_message)
+        # Non-alphabetic characters are left as they are. map() with a default does the lookups in C,
+        # which is faster than str.translate with multi-character replacements
+        message = message.upper()
+        return ' '.join(map(self.encoding_map.get, message, message))
 
     def decode_message(self, meow_message):
-        meow_parts = meow_message.split()
-        decoded_message = []
+        parts = meow_message.split()
+        return ''.join(map(self.decoding_table.get, parts, parts))
+
+    def encode_chunks(self, message, limit=2000, slice_size=65536):
+        # Encodes a string, or an iterable of strings read piece by piece, and yields the result in
+        # pieces of at most `limit` characters split on the spaces between codes. Decoding the pieces
+        # one at a time and joining the results gives the same text as decoding the whole message
+        texts = message
+        if isinstance(message, str):
+            texts = (message[start:start + slice_size] for start in range(0, len(message), slice_size))
+        buffer = ''
+        for text in texts:
+            if not text:
+                continue
+            encoded = self.encode_message(text)
+            buffer = buffer + ' ' + encoded if buffer else encoded
+            position = 0
+            while len(buffer) - position > limit:
+                cut = buffer.rfind(' ', position, position + limit + 1)
+                if cut <= position:
+                    cut = position + limit
+                piece = buffer[position:cut]
+                if piece.strip():
+                    yield piece
+                position = cut + 1 if buffer[cut] == ' ' else cut
+            buffer = buffer[position:]
+        if buffer.strip():
+            yield buffer
 
-        for part in meow_parts:
-            if part in self.decoding_map:
-                decoded_message.append(self.decoding_map[part] + ' ')
-            else:
-                decoded_message.append(part)
-        return ''.join(decoded_message)
+    def decode_chunks(self, chunks):
+        # Decodes meow text arriving in pieces, which may split a code anywhere
+        carry = ''
+        for chunk in chunks:
+            text = carry + chunk
+            parts = text.split()
+            carry = parts.pop() if parts and not text[-1].isspace() else ''
+            if parts:
+                yield ''.join(map(self.decoding_table.get, parts, parts))
+        if carry:
+            yield self.decoding_table.get(carry, carry)
 
 class ConfigLoader:
     def __init__(self, config_directory):
@@ -49,6 +84,94 @@ class ConfigLoader:
         with open(self.config_directory, 'r') as f:
             return json.load(f)
 
+class ConfigService:
+    # Loads a JSON config once and reloads it off the event loop when the file's mtime changes.
+    # Listeners are called with the new config so they can rebuild anything derived from it
+    def __init__(self, config_directory, poll_interval=5):
+        self.config_directory = config_directory
+        self.poll_interval = poll_interval
+        self.config, self.mtime = self.read()
+        self.listeners = []
+        self.task = None
+
+    def read(self):
+        mtime = os.stat(self.config_directory).st_mtime_ns
+        return ConfigLoader(self.config_directory).load_config(), mtime
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.reload_if_changed()
+            except Exception as e:
+                print(f"An error occurred reloading {self.config_directory}: {e}")
+
+    async def reload_if_changed(self):
+        mtime = await asyncio.to_thread(lambda: os.stat(self.config_directory).st_mtime_ns)
+        if mtime == self.mtime:
+            return False
+        self.config, self.mtime = await asyncio.to_thread(self.read)
+        for listener in self.listeners:
+            listener(self.config)
+        return True
+
+class WordFilter:
+    # All filter words compiled into one regex shaped like a trie, so the cost per message depends on
+    # the message length and not on how many words there are
+    # Matching takes microseconds, so the latency buckets are much finer than for I/O
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+    def __init__(self, words, whole_words=False, latency=None):
+        # Filters can share one histogram, e.g. every rule set of the auto-responder
+        self.latency = latency if latency is not None else LatencyHistogram(self.LATENCY_BUCKETS)
+        self.update(words, whole_words)
+
+    def update(self, words, whole_words=False):
+        self.words = tuple(sorted({word.lower() for word in words if word}))
+        self.whole_words = whole_words
+        pattern = self.trie_pattern(self.words)
+        if pattern and whole_words:
+            pattern = rf'\b{pattern}\b'
+        self.pattern = re.compile(pattern) if pattern else None
+
+    @staticmethod
+    def trie_pattern(words):
+        trie = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = {}
+
+        def build(node):
+            branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+            if not branches:
+                return ''
+            pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+            if '' in node:
+                pattern = f'(?:{pattern})?'
+            return pattern
+
+        return build(trie)
+
+    def search(self, message):
+        # Returns the first filter word found in the lowercased message, or None
+        if self.pattern is None:
+            return None
+        start = time.perf_counter()
+        match = self.pattern.search(message)
+        self.latency.record(time.perf_counter() - start)
+        return match.group() if match else None
+
 def simulate_stock_price(current_price):
     change_percent = random.uniform(-0.05, 0.05)
     new_price = current_price * (1 + change_percent)
@@ -57,4 +180,104 @@ def simulate_stock_price(current_price):
 def load_initial_stocks(stock_data):
     with open(stock_data, 'r') as f:
         stocks = json.load(f)["stocks"]
-    return {stock["symbol"]: {"price": stock["price"], "name": stock["name"]} for stock in stocks}
\ No newline at end of file
+    # Everything besides the symbol is kept, so optional fields such as drift and volatility come through
+    return {stock["symbol"]: {key: value for key, value in stock.items() if key != "symbol"} for stock in stocks}
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class LatencyHistogram:
+    # Bucket upper bounds in milliseconds, anything slower lands in the overflow bucket
+    BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, percent):
+        # Upper bound of the bucket holding the given percentile
+        if not self.count:
+            return 0
+        target = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return "n=0"
+        return f"n={self.count} avg={self.total / self.count:.3g}ms p50<={self.percentile(50)}ms p99<={self.percentile(99)}ms max={self.max:.3g}ms"
+
+
+class LoopLagMonitor:
+    # Measures how late the event loop wakes a sleeping task, i.e. how long something blocked it
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.histogram = LatencyHistogram()
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.histogram.record(max(0.0, loop.time() - start - self.interval))
+
+
+class LRUCache:
+    # Bounded mapping that drops the least recently used entry, with hit/miss counters
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def stats_report(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return f"{len(self.entries)}/{self.max_size} entries, hits={self.hits} misses={self.misses} hit rate={hit_rate:.0%}"